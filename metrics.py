@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import json
+import time
+import bisect
+import logging
+import threading
+import http.server
+
+# Default histogram buckets in seconds, from sub-millisecond message handling up
+# to timelapse encodes
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0, 1800.0)
+
+
+class Metric(object):
+    kind = None
+
+    def __init__(self, name, help, labels=None):
+        self.name = name
+        self.help = help
+        self.labels = tuple(sorted((labels or {}).items()))
+        self._lock = threading.Lock()
+
+    @property
+    def family(self):
+        #Name used in the HELP and TYPE lines
+        return self.name
+
+    def label_text(self, extra=()):
+        labels = self.labels + tuple(extra)
+        if not labels:
+            return ''
+        return '{%s}' % ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in labels)
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def __init__(self, name, help, labels=None):
+        super(Counter, self).__init__(name, help, labels)
+        self.value = 0
+
+    @property
+    def family(self):
+        #Counters are exposed with the _total suffix, in the samples as well as in
+        #the HELP and TYPE lines
+        return self.name + '_total'
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def samples(self):
+        return [(self.family, self.label_text(), self.value)]
+
+    def snapshot(self):
+        return self.value
+
+class Gauge(Metric):
+    #Either set explicitly or read from function when collected, e.g. a queue depth
+    kind = 'gauge'
+
+    def __init__(self, name, help, labels=None, function=None):
+        super(Gauge, self).__init__(name, help, labels)
+        self.value = 0
+        self.function = function
+
+    def set(self, value):
+        self.value = value
+
+    def get(self):
+        if self.function is not None:
+            try:
+                return self.function()
+            except Exception as e:
+                logging.debug("gauge %s failed: %s", self.name, e)
+                return float('nan')
+        return self.value
+
+    def samples(self):
+        return [(self.name, self.label_text(), self.get())]
+
+    def snapshot(self):
+        return self.get()
+
+class Histogram(Metric):
+    #Fixed buckets, an observation is a bisect and two additions
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=None, buckets=LATENCY_BUCKETS):
+        super(Histogram, self).__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[i] += 1
+            self.sum += value
+            self.count += 1
+
+    def time(self):
+        return HistogramTimer(self)
+
+    def samples(self):
+        with self._lock:
+            counts = list(self.counts)
+            total = self.sum
+            count = self.count
+        samples = []
+        cumulative = 0
+        for bound, c in zip(self.buckets + (float('inf'),), counts):
+            cumulative += c
+            le = '+Inf' if bound == float('inf') else repr(bound)
+            samples.append((self.name + '_bucket', self.label_text((('le', le),)), cumulative))
+        samples.append((self.name + '_sum', self.label_text(), total))
+        samples.append((self.name + '_count', self.label_text(), count))
+        return samples
+
+    def snapshot(self):
+        return {'count':self.count, 'sum':self.sum}
+
+class HistogramTimer(object):
+    #with histogram.time(): observes the time spent in the block
+
+    __slots__ = ('histogram', 'start')
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start)
+        return False
+
+class MetricsRegistry(object):
+    #Metrics are created once, usually at import, and then updated without lookups
+
+    def __init__(self):
+        self.metrics = []
+        self._lock = threading.Lock()
+
+    def add(self, metric):
+        with self._lock:
+            for m in self.metrics:
+                if m.name == metric.name and m.labels == metric.labels:
+                    return m
+            self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labels=None):
+        return self.add(Counter(name, help, labels))
+
+    def gauge(self, name, help, labels=None, function=None):
+        return self.add(Gauge(name, help, labels, function))
+
+    def histogram(self, name, help, labels=None, buckets=LATENCY_BUCKETS):
+        return self.add(Histogram(name, help, labels, buckets))
+
+    def render(self):
+        #Prometheus text exposition format
+        lines = []
+        seen = set()
+        for m in sorted(self.metrics, key=lambda m: m.family):
+            if m.family not in seen:
+                seen.add(m.family)
+                lines.append('# HELP %s %s' % (m.family, m.help))
+                lines.append('# TYPE %s %s' % (m.family, m.kind))
+            for name, labels, value in m.samples():
+                lines.append('%s%s %s' % (name, labels, repr(float(value))))
+        return '\n'.join(lines) + '\n'
+
+    def snapshot(self):
+        #Plain dict for the JSON stats message
+        stats = {}
+        for m in self.metrics:
+            stats[m.name + m.label_text()] = m.snapshot()
+        return stats
+
+REGISTRY = MetricsRegistry()
+
+
+class MetricsRequestHandler(http.server.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = self.server.registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug("metrics http %s - %s", self.address_string(), format % args)
+
+class MetricsServer(threading.Thread):
+    #Serves /metrics for Prometheus
+
+    def __init__(self, bind='127.0.0.1', port=9100, registry=REGISTRY):
+        super(MetricsServer, self).__init__()
+        self.daemon = True
+        self.bind = bind
+        self.port = port
+        self.registry = registry
+
+    def run(self):
+        httpd = http.server.ThreadingHTTPServer((self.bind, self.port), MetricsRequestHandler)
+        httpd.registry = self.registry
+        logging.info("serving metrics on %s:%d", self.bind, self.port)
+        httpd.serve_forever()
+
+class MetricsPublisher(threading.Thread):
+    #Publishes a JSON snapshot of all metrics every interval seconds
+
+    def __init__(self, mqttClient, topic, interval=60, registry=REGISTRY):
+        super(MetricsPublisher, self).__init__()
+        self.daemon = True
+        self.mqttClient = mqttClient
+        self.topic = topic
+        self.interval = interval
+        self.registry = registry
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                data = {'stats':{'timestamp':time.time(), 'metrics':self.registry.snapshot()}}
+                self.mqttClient.publish(self.topic, json.dumps(data), 0)
+            except Exception as e:
+                logging.exception(e)
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import logging
+import datetime
+import threading
+import collections
+try:
+    import astral
+except ImportError:
+    astral = None
+
+# Raised for days the sun does not reach the depression, astral 1.x has its own
+# error type, later versions raise ValueError
+NO_SUN_ERRORS = (ValueError,)
+if astral is not None and hasattr(astral, 'AstralError'):
+    NO_SUN_ERRORS += (astral.AstralError,)
+
+# Seconds since local midnight of civil dawn, sunrise, sunset and civil dusk
+SolarDay = collections.namedtuple('SolarDay', ['dawn', 'sunrise', 'sunset', 'dusk'])
+
+# Copenhagen, the location the schedule used to be hardcoded to
+DEFAULT_LATITUDE = 55.6761
+DEFAULT_LONGITUDE = 12.5683
+
+
+class SolarSchedule(object):
+    #Dawn, sunrise, sunset and dusk for every day of a year, computed once per year and
+    #location and kept as JSON in cache_dir, so after the first run astral is not needed
+    #at all. Lookups index the table by day of the year. Times are local to the machine,
+    #the same as rrdtool's LTIME
+
+    def __init__(self, latitude=DEFAULT_LATITUDE, longitude=DEFAULT_LONGITUDE, cache_dir=None, depression=6.0):
+        self.latitude = latitude
+        self.longitude = longitude
+        self.cache_dir = cache_dir
+        self.depression = depression
+        self._tables = {}
+        self._lock = threading.Lock()
+
+    def cache_file(self, year):
+        return os.path.join(self.cache_dir, 'solar_%.4f_%.4f_%d.json' % (self.latitude, self.longitude, year))
+
+    def sun_utc(self, date):
+        #Returns dawn, sunrise, sunset and dusk as aware UTC datetimes
+        if astral is None:
+            raise ImportError("astral is needed to compute the solar table")
+        if hasattr(astral, 'Astral'):
+            #astral 1.x
+            a = astral.Astral()
+            a.solar_depression = self.depression
+            sun = a.sun_utc(date, self.latitude, self.longitude)
+        else:
+            #astral 2.x and later
+            from astral.sun import sun as solar
+            sun = solar(astral.Observer(self.latitude, self.longitude), date=date, dawn_dusk_depression=self.depression)
+        return sun['dawn'], sun['sunrise'], sun['sunset'], sun['dusk']
+
+    def compute(self, year):
+        table = []
+        date = datetime.date(year, 1, 1)
+        while date.year == year:
+            try:
+                times = []
+                for t in self.sun_utc(date):
+                    t = t.astimezone()
+                    times.append(t.hour * 3600 + t.minute * 60 + t.second)
+                table.append(times)
+            except NO_SUN_ERRORS:
+                #The sun does not rise or set, keep the previous day
+                table.append(table[-1] if table else [0, 0, 86400, 86400])
+            date += datetime.timedelta(days=1)
+        return table
+
+    def table(self, year):
+        table = self._tables.get(year)
+        if table is not None:
+            return table
+        with self._lock:
+            if year in self._tables:
+                return self._tables[year]
+            if self.cache_dir is not None:
+                try:
+                    with open(self.cache_file(year)) as f:
+                        table = json.load(f)
+                except (IOError, ValueError):
+                    table = None
+            if table is None:
+                logging.info("computing solar table for %d at %f,%f" % (year, self.latitude, self.longitude))
+                table = self.compute(year)
+                if self.cache_dir is not None:
+                    try:
+                        os.makedirs(self.cache_dir, exist_ok=True)
+                        tmp = self.cache_file(year) + '.tmp'
+                        with open(tmp, 'w') as f:
+                            json.dump(table, f)
+                        os.replace(tmp, self.cache_file(year))
+                    except OSError as e:
+                        logging.warning("could not cache solar table: %s" % e)
+            table = [SolarDay(*t) for t in table]
+            self._tables = {year: table}
+        return table
+
+    def day(self, date=None):
+        if date is None:
+            date = datetime.date.today()
+        return self.table(date.year)[date.timetuple().tm_yday - 1]
+
+    def is_daylight(self, now=None, civil=True):
+        #Between dawn and dusk, or sunrise and sunset when civil is False
+        if now is None:
+            now = datetime.datetime.now()
+        day = self.day(now.date())
+        seconds = now.hour * 3600 + now.minute * 60 + now.second
+        if civil:
+            return day.dawn <= seconds < day.dusk
+        return day.sunrise <= seconds < day.sunset
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import io
+import os
+import sys
+import time
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from thermometer_client import ThermometerBusReader
+
+
+def w1_slave(millidegrees, crc='YES'):
+    return ('72 01 4b 46 7f ff 0e 10 57 : crc=57 %s\n'
+            '72 01 4b 46 7f ff 0e 10 57 t=%d\n' % (crc, millidegrees))
+
+
+class FakeSysfs(object):
+    #A /sys/bus/w1/devices tree. Reads of a file return its queued contents in
+    #turn, the last one for good, like a sensor that settles on a value
+    def __init__(self, root):
+        self.root = root
+        self.contents = {}
+        self.written = []
+        self.reads = {}
+
+    def add(self, path, *contents):
+        filename = os.path.join(self.root, path)
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        with open(filename, 'w') as f:
+            f.write(contents[-1])
+        self.contents[filename] = list(contents)
+        return filename
+
+    def add_sensor(self, name, *contents):
+        return self.add(os.path.join(name, 'w1_slave'), *contents)
+
+    def add_master(self, *states):
+        return self.add(os.path.join('w1_bus_master1', 'therm_bulk_read'), *states)
+
+    def open(self, filename, mode='r'):
+        if 'w' in mode:
+            self.written.append(filename)
+            return io.StringIO()
+        queued = self.contents[filename]
+        self.reads[filename] = self.reads.get(filename, 0) + 1
+        return io.StringIO(queued.pop(0) if len(queued) > 1 else queued[0])
+
+
+class ThermometerBusReaderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.sysfs = FakeSysfs(self.dir)
+        patcher = mock.patch('thermometer_client.open', self.sysfs.open, create=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.reader = ThermometerBusReader('host', base_dir=self.dir, conversion_timeout=0.5)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def test_discover(self):
+        self.sysfs.add_sensor('28-0000000000a1', w1_slave(21000))
+        self.sysfs.add_master('1')
+        self.assertEqual(self.reader.discover(), ['28-0000000000a1'])
+        self.assertEqual(self.reader.discover(), [])
+        self.sysfs.add_sensor('28-0000000000a2', w1_slave(22000))
+        self.assertEqual(self.reader.discover(), ['28-0000000000a2'])
+
+    def test_bulk_trigger_waits_for_conversion(self):
+        sensor = self.sysfs.add_sensor('28-0000000000b1', w1_slave(21500))
+        master = self.sysfs.add_master('-1', '-1', '1')
+        self.reader.discover()
+        self.assertEqual(self.reader.read_all(), {'28-0000000000b1':21.5})
+        self.assertEqual(self.sysfs.written, [master])
+        #Polled until the conversion finished, then the sensor is read
+        self.assertEqual(self.sysfs.reads[master], 3)
+        self.assertEqual(self.sysfs.reads[sensor], 1)
+
+    def test_bulk_conversion_times_out(self):
+        self.sysfs.add_sensor('28-0000000000b2', w1_slave(21500))
+        self.sysfs.add_master('-1')
+        self.reader.discover()
+        start = time.monotonic()
+        self.assertTrue(self.reader.trigger_conversion())
+        self.assertGreaterEqual(time.monotonic() - start, 0.5)
+        self.assertLess(time.monotonic() - start, 1.5)
+
+    def test_without_bulk_read(self):
+        self.sysfs.add_sensor('28-0000000000b3', w1_slave(19000))
+        self.reader.discover()
+        self.assertFalse(self.reader.trigger_conversion())
+        self.assertEqual(self.reader.read_all(), {'28-0000000000b3':19.0})
+        self.assertEqual(self.sysfs.written, [])
+
+    def test_crc_retry(self):
+        sensor = self.sysfs.add_sensor('28-0000000000c1', w1_slave(0, 'NO'), w1_slave(-1250))
+        self.reader.discover()
+        self.assertEqual(self.reader.read_all(), {'28-0000000000c1':-1.25})
+        self.assertEqual(self.sysfs.reads[sensor], 2)
+        self.assertEqual(self.reader.errors['28-0000000000c1'].value, 0)
+
+    def test_skips_power_on_value(self):
+        sensor = self.sysfs.add_sensor('28-0000000000c2', w1_slave(85000), w1_slave(23000))
+        self.reader.discover()
+        self.assertEqual(self.reader.read_all(), {'28-0000000000c2':23.0})
+        self.assertEqual(self.sysfs.reads[sensor], 2)
+
+    def test_error_counters(self):
+        self.sysfs.add_sensor('28-0000000000d1', w1_slave(20000, 'NO'))
+        self.sysfs.add_sensor('28-0000000000d2', w1_slave(85000))
+        self.sysfs.add_sensor('28-0000000000d3', w1_slave(20000))
+        self.reader.discover()
+        for i in range(2):
+            self.assertEqual(self.reader.read_all(), {'28-0000000000d3':20.0})
+        for s in ('28-0000000000d1', '28-0000000000d2', '28-0000000000d3'):
+            self.assertEqual(self.reader.reads[s].value, 2)
+        self.assertEqual(self.reader.errors['28-0000000000d1'].value, 2)
+        self.assertEqual(self.reader.errors['28-0000000000d2'].value, 2)
+        self.assertEqual(self.reader.errors['28-0000000000d3'].value, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
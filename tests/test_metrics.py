@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from metrics import MetricsRegistry
+
+
+class RenderTest(unittest.TestCase):
+
+    def test_counter_family_has_total_suffix(self):
+        registry = MetricsRegistry()
+        registry.counter('frames_sent', 'Frames sent', {'host':'a'}).inc(2)
+        registry.counter('frames_sent', 'Frames sent', {'host':'b'}).inc()
+        lines = registry.render().splitlines()
+        self.assertEqual(lines, [
+            '# HELP frames_sent_total Frames sent',
+            '# TYPE frames_sent_total counter',
+            'frames_sent_total{host="a"} 2.0',
+            'frames_sent_total{host="b"} 1.0',
+        ])
+
+    def test_gauge_and_histogram_families(self):
+        registry = MetricsRegistry()
+        registry.gauge('queue_depth', 'Queued', function=lambda: 3)
+        registry.histogram('latency_seconds', 'Latency', buckets=(1.0,)).observe(0.5)
+        lines = registry.render().splitlines()
+        self.assertEqual(lines, [
+            '# HELP latency_seconds Latency',
+            '# TYPE latency_seconds histogram',
+            'latency_seconds_bucket{le="1.0"} 1.0',
+            'latency_seconds_bucket{le="+Inf"} 1.0',
+            'latency_seconds_sum 0.5',
+            'latency_seconds_count 1.0',
+            '# HELP queue_depth Queued',
+            '# TYPE queue_depth gauge',
+            'queue_depth 3.0',
+        ])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from thermometer_client import Outbox
+
+# paho's MQTT_ERR_NO_CONN
+ERR_NO_CONN = 4
+
+
+class FakeMessageInfo(object):
+    def __init__(self, mid, rc):
+        self.mid = mid
+        self.rc = rc
+        self.published = threading.Event()
+
+    def wait_for_publish(self, timeout=None):
+        self.published.wait(timeout)
+
+    def is_published(self):
+        return self.published.is_set()
+
+class FakeBrokerClient(object):
+    #Stands in for a paho client and a local broker. Like paho, a QoS 1 or 2
+    #message published while disconnected is queued and sent after the next
+    #connect, a QoS 0 one is dropped. With hold_acks the broker does not
+    #acknowledge, the messages stay queued until a reconnect
+    def __init__(self):
+        self.connected = False
+        self.hold_acks = False
+        self.received = []
+        self.queued = []
+        self.mid = 0
+        self.outbox = None
+        self.before_publish = None
+        self.lock = threading.Lock()
+
+    def publish(self, topic, payload, qos=0):
+        if self.before_publish is not None:
+            hook, self.before_publish = self.before_publish, None
+            hook()
+        with self.lock:
+            self.mid += 1
+            if not self.connected:
+                info = FakeMessageInfo(self.mid, ERR_NO_CONN)
+                if qos > 0:
+                    self.queued.append((info, (topic, payload, qos)))
+                return info
+            info = FakeMessageInfo(self.mid, 0)
+            if self.hold_acks and qos > 0:
+                self.queued.append((info, (topic, payload, qos)))
+                return info
+            self.received.append((topic, payload, qos))
+        self.acknowledge(info)
+        return info
+
+    def acknowledge(self, info):
+        info.published.set()
+        self.outbox.on_publish(self, None, info.mid)
+
+    def connect(self, outbox):
+        self.outbox = outbox
+        with self.lock:
+            self.connected = True
+            queued, self.queued = self.queued, []
+            for info, message in queued:
+                self.received.append(message)
+        outbox.on_connect(self, None, {}, 0)
+        for info, message in queued:
+            self.acknowledge(info)
+
+    def disconnect(self, outbox):
+        self.connected = False
+        outbox.on_disconnect(self, None, 1)
+
+
+class OutboxTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.dir, 'outbox.sqlite3')
+        self.client = FakeBrokerClient()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def outbox(self, **kwargs):
+        outbox = Outbox(self.filename, self.client, rate=1000, **kwargs)
+        self.client.outbox = outbox
+        outbox.start()
+        return outbox
+
+    def rows(self, outbox):
+        with outbox.lock:
+            return [r[0] for r in outbox.db.execute('SELECT topic FROM Outbox ORDER BY id')]
+
+    def wait_for(self, condition, timeout=5):
+        deadline = time.monotonic() + timeout
+        while not condition():
+            if time.monotonic() > deadline:
+                self.fail("timed out")
+            time.sleep(0.01)
+
+    def test_drains_in_order_after_reconnect(self):
+        outbox = self.outbox()
+        infos = [outbox.publish('t%d' % i, 'payload %d' % i, 1) for i in range(5)]
+        time.sleep(0.1)
+        self.assertEqual(self.client.received, [])
+        self.assertEqual(outbox.get_stats()['messages'], 5)
+
+        self.client.connect(outbox)
+        self.wait_for(lambda: outbox.get_stats()['messages'] == 0)
+        self.assertEqual([r[0] for r in self.client.received], ['t%d' % i for i in range(5)])
+        self.assertEqual(self.client.received[0][1], b'payload 0')
+        self.assertTrue(all(i.is_published() for i in infos))
+        self.assertEqual(self.rows(outbox), [])
+
+    def test_keeps_messages_over_a_disconnect(self):
+        outbox = self.outbox()
+        self.client.connect(outbox)
+        outbox.publish('t0', 'a', 1)
+        self.wait_for(lambda: len(self.client.received) == 1)
+        self.client.disconnect(outbox)
+        outbox.publish('t1', 'b', 1)
+        outbox.publish('t2', 'c', 1)
+        time.sleep(0.1)
+        self.assertEqual(self.rows(outbox), ['t1', 't2'])
+
+        self.client.connect(outbox)
+        self.wait_for(lambda: outbox.get_stats()['messages'] == 0)
+        self.assertEqual([r[0] for r in self.client.received], ['t0', 't1', 't2'])
+
+    def test_evicts_oldest(self):
+        outbox = self.outbox(max_messages=3)
+        infos = [outbox.publish('t%d' % i, 'x', 1) for i in range(5)]
+        stats = outbox.get_stats()
+        self.assertEqual((stats['messages'], stats['evicted']), (3, 2))
+        self.assertEqual(self.rows(outbox), ['t2', 't3', 't4'])
+
+        self.client.connect(outbox)
+        self.wait_for(lambda: outbox.get_stats()['messages'] == 0)
+        self.assertEqual([r[0] for r in self.client.received], ['t2', 't3', 't4'])
+        self.assertFalse(infos[0].is_published())
+
+    def test_evicts_lowest_qos_first(self):
+        outbox = self.outbox(max_bytes=30, evict='qos')
+        outbox.publish('reading0', 'r' * 10, 2)
+        outbox.publish('image0', 'i' * 10, 0)
+        outbox.publish('reading1', 'r' * 10, 2)
+        outbox.publish('reading2', 'r' * 10, 2)
+        self.assertEqual(self.rows(outbox), ['reading0', 'reading1', 'reading2'])
+        self.assertEqual(outbox.get_stats()['bytes'], 30)
+
+    def test_resumes_after_restart(self):
+        outbox = Outbox(self.filename, self.client)
+        outbox.publish('t0', 'a', 1)
+        outbox.publish('t1', 'b', 1)
+        outbox.db.close()
+
+        outbox = self.outbox()
+        self.assertEqual(outbox.get_stats()['messages'], 2)
+        self.client.connect(outbox)
+        self.wait_for(lambda: outbox.get_stats()['messages'] == 0)
+        self.assertEqual([r[0] for r in self.client.received], ['t0', 't1'])
+
+    def test_eviction_while_sending(self):
+        #The message being sent is evicted before the broker acknowledges it, it
+        #must only be taken off the counts once
+        outbox = self.outbox(max_messages=2)
+        def publish_more():
+            outbox.publish('t1', 'bb', 1)
+            outbox.publish('t2', 'cc', 1)
+        self.client.before_publish = publish_more
+        self.client.connect(outbox)
+        outbox.publish('t0', 'a', 1)
+        self.wait_for(lambda: len(self.client.received) == 3)
+        self.wait_for(lambda: self.rows(outbox) == [])
+        stats = outbox.get_stats()
+        self.assertEqual((stats['messages'], stats['bytes'], stats['evicted']), (0, 0, 1))
+
+    def test_leaves_messages_queued_by_paho(self):
+        #The connection drops right before the publish, paho queues the message
+        #and sends it itself after the reconnect
+        outbox = self.outbox()
+        self.client.connect(outbox)
+        self.client.before_publish = lambda: self.client.disconnect(outbox)
+        info = outbox.publish('t0', 'a', 1)
+        self.wait_for(lambda: outbox.get_stats()['inflight'] == 1)
+        outbox.publish('t1', 'b', 1)
+        time.sleep(0.1)
+        self.assertEqual(self.client.received, [])
+
+        self.client.connect(outbox)
+        self.wait_for(lambda: outbox.get_stats()['messages'] == 0)
+        time.sleep(0.1)
+        self.assertEqual([r[0] for r in self.client.received], ['t0', 't1'])
+        self.assertTrue(info.is_published())
+        self.assertEqual(outbox.get_stats()['inflight'], 0)
+
+    def test_leaves_unacknowledged_messages_to_paho(self):
+        #wait_for_publish times out, the message is still held by paho
+        outbox = self.outbox(publish_timeout=0.05)
+        self.client.hold_acks = True
+        self.client.connect(outbox)
+        outbox.publish('t0', 'a', 1)
+        self.wait_for(lambda: outbox.get_stats()['inflight'] == 1)
+        time.sleep(1.2)
+        self.assertEqual(len(self.client.queued), 1)
+        self.assertEqual(self.rows(outbox), ['t0'])
+
+        self.client.hold_acks = False
+        self.client.disconnect(outbox)
+        self.client.connect(outbox)
+        self.wait_for(lambda: outbox.get_stats()['messages'] == 0)
+        self.assertEqual([r[0] for r in self.client.received], ['t0'])
+
+    def test_republishes_dropped_qos0(self):
+        #paho drops a QoS 0 message published while disconnected
+        outbox = self.outbox()
+        self.client.connect(outbox)
+        self.client.before_publish = lambda: self.client.disconnect(outbox)
+        outbox.publish('t0', 'a', 0)
+        time.sleep(0.1)
+        self.assertEqual(outbox.get_stats()['inflight'], 0)
+        self.assertEqual(self.rows(outbox), ['t0'])
+
+        self.client.connect(outbox)
+        self.wait_for(lambda: outbox.get_stats()['messages'] == 0)
+        self.assertEqual([r[0] for r in self.client.received], ['t0'])
+
+    def test_limits_messages_held_by_paho(self):
+        outbox = self.outbox(max_inflight=2, publish_timeout=0.01)
+        self.client.hold_acks = True
+        self.client.connect(outbox)
+        for i in range(5):
+            outbox.publish('t%d' % i, 'x', 1)
+        self.wait_for(lambda: outbox.get_stats()['inflight'] == 2)
+        time.sleep(2.5)
+        self.assertEqual(len(self.client.queued), 2)
+
+        self.client.hold_acks = False
+        self.client.disconnect(outbox)
+        self.client.connect(outbox)
+        self.wait_for(lambda: outbox.get_stats()['messages'] == 0)
+        self.assertEqual([r[0] for r in self.client.received], ['t%d' % i for i in range(5)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from thermometer_server import ReadingStore
+
+DAY = 86400
+
+
+class ReadingStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.store = ReadingStore(self.dir, block_rows=1000)
+        #Midnight UTC, three days back
+        self.day0 = (int(time.time()) // DAY - 3) * DAY
+        for sensorId in (1, 2):
+            for day in range(3):
+                for hour in range(0, 24, 6):
+                    t = self.day0 + day * DAY + hour * 3600
+                    self.store.append(sensorId, t, sensorId * 100 + day * 10 + hour / 6)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def test_query_whole_days(self):
+        rows = self.store.query(1, self.day0, self.day0 + 2 * DAY)
+        self.assertEqual([t for t, v in rows], [self.day0 + h * 3600 for h in range(0, 48, 6)])
+        self.assertEqual([v for t, v in rows], [100, 101, 102, 103, 110, 111, 112, 113])
+
+    def test_query_partial_days(self):
+        #From 12:00 on the first day up to, but not including, 06:00 on the third
+        rows = self.store.query(2, self.day0 + 12 * 3600, self.day0 + 2 * DAY + 6 * 3600)
+        self.assertEqual([v for t, v in rows], [202, 203, 210, 211, 212, 213, 220])
+        self.assertEqual(rows[0][0], self.day0 + 12 * 3600)
+        self.assertEqual(rows[-1][0], self.day0 + 2 * DAY)
+
+    def test_query_unknown_sensor(self):
+        self.assertEqual(self.store.query(3, self.day0, self.day0 + 3 * DAY), [])
+
+    def test_query_reads_buffered_rows(self):
+        t = self.day0 + 2 * DAY + 60
+        self.store.append(1, t, 42.5)
+        self.assertIn((t, 42.5), self.store.query(1, t, t + 1))
+
+    def test_append_rejects_non_numeric(self):
+        with self.assertRaises(ValueError):
+            self.store.append(1, self.day0, 'abc')
+        self.assertEqual(len(self.store.query(1, self.day0, self.day0 + DAY)), 4)
+
+    def test_drop_partitions(self):
+        self.store.flush()
+        days = [time.strftime('%Y%m%d', time.gmtime(self.day0 + d * DAY)) for d in range(3)]
+        self.assertEqual(self.store.partitions(), days)
+
+        #Keeps the last two days and today
+        self.assertEqual(self.store.drop_partitions(2), days[:1])
+        self.assertEqual(self.store.partitions(), days[1:])
+        self.assertEqual(self.store.query(1, self.day0, self.day0 + DAY), [])
+        self.assertEqual(len(self.store.query(1, self.day0 + DAY, self.day0 + 3 * DAY)), 8)
+        self.assertEqual(self.store.drop_partitions(2), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
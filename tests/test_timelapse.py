@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from thermometer_server import IncrementalTimelapse
+
+# Stands in for ffmpeg: image2pipe input is copied to the output, a concat list
+# is joined byte by byte
+FAKE_FFMPEG = r'''#!%s
+import sys
+args = sys.argv[1:]
+output = args[-1]
+if 'concat' in args:
+    with open(args[args.index('-i') + 1]) as f:
+        inputs = [l.strip()[len("file '"):-1] for l in f if l.strip()]
+    data = b''.join(open(i, 'rb').read() for i in inputs)
+else:
+    data = sys.stdin.buffer.read()
+with open(output, 'wb') as f:
+    f.write(data)
+''' % sys.executable
+
+
+class IncrementalTimelapseTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        bin = os.path.join(self.dir, 'bin')
+        os.mkdir(bin)
+        with open(os.path.join(bin, 'ffmpeg'), 'wt') as f:
+            f.write(FAKE_FFMPEG)
+        os.chmod(os.path.join(bin, 'ffmpeg'), 0o755)
+        self.path = os.environ['PATH']
+        os.environ['PATH'] = bin + os.pathsep + self.path
+        self.timelapsePath = os.path.join(self.dir, 'timelapse')
+        os.mkdir(self.timelapsePath)
+        self.timelapse = IncrementalTimelapse(self.timelapsePath)
+
+    def tearDown(self):
+        self.timelapse.close()
+        os.environ['PATH'] = self.path
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def read(self, name):
+        with open(os.path.join(self.timelapsePath, name), 'rb') as f:
+            return f.read()
+
+    def test_finalize_joins_segments(self):
+        self.timelapse.add_frame('cam', '2026-01-01', b'a')
+        self.timelapse.add_frame('cam', '2026-01-01', b'b')
+        self.timelapse.finalize_before('2026-01-02')
+        self.assertEqual(self.read('cam_2026-01-01.avi'), b'ab')
+        self.assertEqual(self.timelapse.segments(), [])
+
+    def test_late_frame_does_not_close_todays_session(self):
+        self.timelapse.add_frame('cam', '2026-01-02', b'x')
+        self.timelapse.add_frame('cam', '2026-01-01', b'late')
+        self.timelapse.add_frame('cam', '2026-01-02', b'y')
+        self.assertEqual(sorted(self.timelapse.sessions), [('cam', '2026-01-01'), ('cam', '2026-01-02')])
+
+        self.timelapse.finalize_before('2026-01-02')
+        self.assertEqual(self.read('cam_2026-01-01.avi'), b'late')
+        self.assertEqual(list(self.timelapse.sessions), [('cam', '2026-01-02')])
+        self.timelapse.finalize_before('2026-01-03')
+        self.assertEqual(self.read('cam_2026-01-02.avi'), b'xy')
+
+    def test_late_frames_are_appended_to_a_finalized_day(self):
+        self.timelapse.add_frame('cam', '2026-01-01', b'a')
+        self.timelapse.finalize_before('2026-01-02')
+        self.timelapse.add_frame('cam', '2026-01-01', b'late')
+        self.timelapse.finalize_before('2026-01-02')
+        self.assertEqual(self.read('cam_2026-01-01.avi'), b'alate')
+        self.assertEqual(sorted(os.listdir(self.timelapsePath)), ['cam_2026-01-01.avi'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import argparse
+import datetime
+import tempfile
+from thermometer_client import ThermometerProtocol
+from thermometer_server import ThermometerServer, SurveillanceDatabase, RRDGraphCreator
+from solar_schedule import SolarSchedule
+from metrics import REGISTRY
+
+# Feeds synthetic client messages through the server's handlers, without a broker,
+# in a temporary prefix. Every stage reports throughput, per message latency
+# percentiles and the bytes it added to the prefix as JSON, so runs on different
+# machines or commits can be compared with a diff.
+
+
+class FakeMessage(object):
+    #The attributes of paho's MQTTMessage the server reads
+    def __init__(self, topic, payload, qos=2):
+        self.topic = topic
+        self.payload = payload if isinstance(payload, bytes) else payload.encode('utf-8')
+        self.qos = qos
+
+class FakeClient(object):
+    def __init__(self):
+        self.published = 0
+
+    def publish(self, topic, payload, qos=0, retain=False):
+        self.published += 1
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))]
+
+def disk_usage(path):
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for f in files:
+            try:
+                total += os.path.getsize(os.path.join(root, f))
+            except OSError:
+                pass
+    return total
+
+
+class ThermometerBenchmark(object):
+
+    def __init__(self, prefix, hosts=4, sensors=50, readings=20, images=50, image_size=500000, graph_rounds=3, server_args=None):
+        self.prefix = prefix
+        self.hosts = ['host%d' % h for h in range(hosts)]
+        self.sensors = ['28-%012x' % s for s in range(sensors)]
+        self.readings = readings
+        self.images = images
+        self.image_size = image_size
+        self.graph_rounds = graph_rounds
+        self.protocol = ThermometerProtocol()
+        self.client = FakeClient()
+        self.server = ThermometerServer()
+        #Messages are handled in the calling thread so every latency covers the whole path
+        self.args = self.server.get_args(['--prefix', prefix, '--ingest-workers', '0'] + (server_args or []))
+        self.results = []
+
+    def sensor_pairs(self):
+        #Spreads the sensors over the hosts
+        return [(self.hosts[i % len(self.hosts)], s) for i, s in enumerate(self.sensors)]
+
+    def setup(self):
+        server = self.server
+        server.database = SurveillanceDatabase.get_instance()
+        server.setup(self.prefix, self.args.db_batch_size, self.args.db_batch_interval, self.args.db_synchronous, self.args.migrate_chunk_size)
+        server.setup_ingest(self.args, self.client)
+
+    def measure(self, stage, items, func, flush=None):
+        before = disk_usage(self.prefix)
+        latencies = []
+        start = time.perf_counter()
+        for item in items:
+            t = time.perf_counter()
+            func(item)
+            latencies.append(time.perf_counter() - t)
+        if flush is not None:
+            flush()
+        seconds = time.perf_counter() - start
+        written = disk_usage(self.prefix) - before
+        result = {'stage':stage,
+                  'messages':len(latencies),
+                  'seconds':seconds,
+                  'throughput':len(latencies) / seconds if seconds > 0 else None,
+                  'p50_ms':percentile(latencies, 50) * 1000.0 if latencies else None,
+                  'p99_ms':percentile(latencies, 99) * 1000.0 if latencies else None,
+                  'bytes_written':written,
+                  'bytes_per_message':written / float(len(latencies)) if latencies else None}
+        logging.info("%s: %d messages in %.2fs" % (stage, len(latencies), seconds))
+        self.results.append(result)
+        return result
+
+    def flush(self):
+        server = self.server
+        server.rrdUpdater.flush()
+        server.registry.flush()
+        server.readingStore.flush()
+        server.database.flush()
+
+    def deliver(self, msg):
+        self.server.on_message(self.client, self.args, msg)
+
+    def reading_messages(self, start):
+        #One reading per sensor and RRD step, in time order
+        messages = []
+        for i in range(self.readings):
+            timestamp = str(datetime.datetime.fromtimestamp(start + i * 60))
+            for host, sensor in self.sensor_pairs():
+                topic = "/surveillance/temperature/bench/%s" % host
+                messages.append(FakeMessage(topic, self.protocol.new_reading(host, sensor, 20.0 + (i % 10) * 0.1, timestamp)))
+        return messages
+
+    def batch_messages(self, start):
+        messages = []
+        for i in range(self.readings):
+            for host in self.hosts:
+                rows = [[sensor, start + i * 60, 20.0 + (i % 10) * 0.1] for h, sensor in self.sensor_pairs() if h == host]
+                messages.append(FakeMessage("/surveillance/readingbin/%s" % host, self.protocol.new_binary_reading_batch(host, ['reading'], rows)))
+        return messages
+
+    def image_messages(self):
+        #A JPEG sized payload is enough, the server never decodes the image
+        image = b'\xff\xd8' + os.urandom(self.image_size - 4) + b'\xff\xd9'
+        messages = []
+        now = datetime.datetime.now()
+        for i in range(self.images):
+            host = self.hosts[i % len(self.hosts)]
+            timestamp = now + datetime.timedelta(seconds=i)
+            messages.append(FakeMessage("/surveillance/imagebin/%s" % host, self.protocol.new_image_header(host, timestamp, 'full') + image, 0))
+        return messages
+
+    def run(self):
+        server = self.server
+        self.setup()
+        registrations = [FakeMessage("/surveillance/temperature/bench/%s" % h, self.protocol.new_sensor(h, s)) for h, s in self.sensor_pairs()]
+        self.measure('register', registrations, self.deliver, self.flush)
+
+        #RRD files are created with --start now, updates have to be newer
+        start = int(time.time()) + 60
+        self.measure('readings', self.reading_messages(start), self.deliver, self.flush)
+        start += self.readings * 60
+        self.measure('reading_batches', self.batch_messages(start), self.deliver, self.flush)
+        start += self.readings * 60
+
+        pairs = self.sensor_pairs()
+        registry = server.registry
+        rows = [(registry.get(h, s).id, start + i, 20.0) for i in range(self.readings) for h, s in pairs]
+        self.measure('database', rows, lambda r: server.database.insert_reading('bench', r[0], r[1], r[2]), server.database.flush)
+        updates = [(h, s, 20.0, start + i * 60) for i in range(self.readings) for h, s in pairs]
+        self.measure('rrd', updates, lambda u: server.update_rrd(*u), server.rrdUpdater.flush)
+
+        self.measure('images', self.image_messages(), self.deliver, self.flush)
+
+        server.database._write("UPDATE Sensors SET rrdGraph=1", ())
+        server.database.flush()
+        registry.load()
+        graphCreator = RRDGraphCreator(server.rrdPath, server.rrdImagePath, server.databaseFile, self.client, server.rrdUpdater, workers=0, registry=registry,
+                                       solar=SolarSchedule(self.args.latitude, self.args.longitude, server.databasePath))
+        graphCreator.database = server.database
+        self.measure('graphs', range(self.graph_rounds), lambda i: graphCreator.create_rrd_graph(force=True))
+
+        server.pipeline.stop()
+        server.readingStore.close()
+        server.database.close()
+        return {'hosts':len(self.hosts), 'sensors':len(self.sensors), 'readings':self.readings,
+                'images':self.images, 'image_size':self.image_size, 'stages':self.results, 'metrics':REGISTRY.snapshot()}
+
+
+
+def get_args():
+    ap = argparse.ArgumentParser(description="Benchmark the server's ingest, storage and render paths")
+    ap.add_argument('--hosts',help="Number of simulated clients", type=int, default=4)
+    ap.add_argument('--sensors',help="Number of simulated sensors, spread over the hosts", type=int, default=50)
+    ap.add_argument('--readings',help="Readings per sensor", type=int, default=20)
+    ap.add_argument('--images',help="Number of images", type=int, default=50)
+    ap.add_argument('--image-size',help="Image size in bytes", type=int, default=500000)
+    ap.add_argument('--graph-rounds',help="Number of times all graphs are rendered", type=int, default=3)
+    ap.add_argument('--prefix',help="Directory to run in, default is a temporary directory that is removed afterwards")
+    ap.add_argument('-o','--output',help="Write the results to this file instead of stdout")
+    ap.add_argument('-v', help="Increase log level, can be specified multiple times", action='count', default=1)
+    ap.add_argument('server_args',help="Server options to benchmark with, after --, e.g. -- --db-batch-size 0", nargs=argparse.REMAINDER)
+    return ap.parse_args()
+
+def main():
+    args = get_args()
+    logging.basicConfig(format='%(asctime)s %(levelname)s: %(message)s', level=logging.INFO if args.v > 1 else logging.WARNING)
+    server_args = [a for a in args.server_args if a != '--']
+    prefix = args.prefix or tempfile.mkdtemp(prefix='thermometer_benchmark_')
+    try:
+        benchmark = ThermometerBenchmark(prefix, args.hosts, args.sensors, args.readings, args.images, args.image_size, args.graph_rounds, server_args)
+        results = benchmark.run()
+        results['server_args'] = server_args
+    finally:
+        if args.prefix is None:
+            shutil.rmtree(prefix, ignore_errors=True)
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+
+if __name__ == '__main__':
+    main()
@@ -12,19 +12,39 @@ import threading
 import os
 import glob
 import io
+import struct
+import collections
+import sqlite3
 #import pdb
 try:
     import picamera
-    import astral
 except:
     pass
+try:
+    import numpy
+except ImportError:
+    numpy = None
 from base64 import b64encode
-
-os.system('modprobe w1-gpio')
-os.system('modprobe w1-therm')
+from solar_schedule import SolarSchedule
+from metrics import REGISTRY, MetricsServer, MetricsPublisher
 
 base_dir = '/sys/bus/w1/devices/'
 
+# Binary image messages are the magic, a 2 byte big endian header length, a
+# small JSON header with the metadata and then the raw JPEG bytes.
+IMAGE_HEADER_MAGIC = b'RPSI'
+# Binary reading batches use the same layout with their own magic. The header
+# names the sensors and the value fields, followed by fixed size rows of a one
+# byte sensor index, a 4 byte epoch and one float per field.
+READING_BATCH_MAGIC = b'RPSB'
+
+SENSOR_READ_SECONDS = REGISTRY.histogram('sensor_read_seconds', "Time to read one 1-Wire sensor, including retries")
+BULK_CONVERSION_SECONDS = REGISTRY.histogram('sensor_conversion_seconds', "Time for a bulk temperature conversion of the 1-Wire bus")
+CAMERA_CAPTURE_SECONDS = REGISTRY.histogram('camera_capture_seconds', "Time to capture and encode one image")
+IMAGE_BYTES_CAPTURED = REGISTRY.counter('image_bytes_captured', "Bytes of JPEG images captured")
+FRAMES_SKIPPED = REGISTRY.counter('camera_frames_skipped', "Frames not sent because the scene did not change")
+FRAMES_SENT = REGISTRY.counter('camera_frames_sent', "Frames the change detector let through")
+
 class ThermometerProtocol(object):
 
     def new_reading(self, host, sensor, reading, timestamp=None):
@@ -43,6 +63,33 @@ class ThermometerProtocol(object):
         data = {'surveillance':{'host':host, 'image':image, 'timestamp':timestamp}}
         return json.dumps(data)
 
+    def new_image_header(self, host, timestamp=None, rendition=None):
+        if timestamp is None:
+            timestamp = datetime.datetime.now()
+        timestamp = str(timestamp)
+
+        header = {'host':host, 'timestamp':timestamp}
+        if rendition is not None:
+            header['rendition'] = rendition
+        header = json.dumps(header).encode('utf-8')
+        return IMAGE_HEADER_MAGIC + struct.pack('!H', len(header)) + header
+
+    def new_binary_image(self, host, image, timestamp=None):
+        return self.new_image_header(host, timestamp) + image
+
+    def new_reading_batch(self, host, fields, rows):
+        #rows are [sensor, epoch, value, ...] with one value per field
+        data = {'readings':{'host':host, 'fields':['sensor','timestamp'] + fields, 'rows':rows}}
+        return json.dumps(data, separators=(',',':'))
+
+    def new_binary_reading_batch(self, host, fields, rows):
+        sensors = sorted(set(r[0] for r in rows))
+        index = dict((s, i) for i, s in enumerate(sensors))
+        header = json.dumps({'host':host, 'sensors':sensors, 'fields':fields}).encode('utf-8')
+        row = struct.Struct('!BI' + 'f' * len(fields))
+        body = b''.join(row.pack(index[r[0]], int(r[1]), *r[2:]) for r in rows)
+        return READING_BATCH_MAGIC + struct.pack('!H', len(header)) + header + body
+
     def new_notification(self, notification):
         data = {'notification':notification}
         return json.dumps(data)
@@ -51,93 +98,621 @@ class ThermometerProtocol(object):
         data = {'register_sensor':{'host':host, 'sensor':sensor}}
         return json.dumps(data)
 
+class CameraSession(object):
+    #Keeps one camera open between captures instead of paying sensor warm-up and
+    #exposure settling for every frame. Frames come from capture_continuous, optionally
+    #through the video port for fast bursts. After an error the camera is closed and
+    #reopened by the next capture
+
+    def __init__(self, resolution=(2592, 1944), use_video_port=False, warmup=2.0):
+        self.resolution = resolution
+        self.use_video_port = use_video_port
+        self.warmup = warmup
+        self.camera = None
+        self.stream = io.BytesIO()
+        self.frames = None
+        self.quality = None
+        self.opened = None
+        self.startup_latency = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    def open(self):
+        self.opened = time.time()
+        self.camera = picamera.PiCamera()
+        self.camera.resolution = self.resolution
+        #Let auto exposure and white balance settle
+        time.sleep(self.warmup)
+
+    def _close_frames(self):
+        #Closing the generator stops its encoder, a generator that is just dropped
+        #keeps it until it is garbage collected
+        if self.frames is not None:
+            try:
+                self.frames.close()
+            except Exception as e:
+                logging.exception(e)
+        self.frames = None
+
+    def _frames(self, quality):
+        if self.frames is None or quality != self.quality:
+            self._close_frames()
+            options = {'use_video_port':self.use_video_port}
+            if quality is not None:
+                options['quality'] = quality
+            self.frames = self.camera.capture_continuous(self.stream, 'jpeg', **options)
+            self.quality = quality
+        return self.frames
+
+    def close(self):
+        self._close_frames()
+        if self.camera is not None:
+            try:
+                self.camera.close()
+            except Exception as e:
+                logging.exception(e)
+        self.camera = None
+
+    def capture(self, prefix=b'', quality=None):
+        #Returns prefix followed by a JPEG, the camera writes right after the prefix
+        try:
+            if self.camera is None:
+                self.open()
+            self.stream.seek(0)
+            self.stream.truncate()
+            self.stream.write(prefix)
+            next(self._frames(quality))
+            if self.opened is not None:
+                self.startup_latency = time.time() - self.opened
+                self.opened = None
+                logging.info("camera startup to first frame took %.2fs" % self.startup_latency)
+            return self.stream.getvalue()
+        except Exception:
+            self.close()
+            raise
+
+    def capture_resized(self, prefix, size, quality=None):
+        #Downscaled JPEG from the video splitter port, without touching the full resolution stream
+        try:
+            if self.camera is None:
+                self.open()
+            options = {'resize':size, 'use_video_port':True, 'splitter_port':2}
+            if quality is not None:
+                options['quality'] = quality
+            with io.BytesIO() as stream:
+                stream.write(prefix)
+                self.camera.capture(stream, 'jpeg', **options)
+                return stream.getvalue()
+        except Exception:
+            self.close()
+            raise
+
+    def capture_thumbnail(self, size=(64, 48)):
+        #Small grayscale frame from the video splitter port. Width and height must be
+        #multiples of 32 and 16, so the Y plane is exactly the first width*height bytes
+        try:
+            if self.camera is None:
+                self.open()
+            with io.BytesIO() as stream:
+                self.camera.capture(stream, 'yuv', resize=size, use_video_port=True, splitter_port=1)
+                return stream.getvalue()[:size[0]*size[1]]
+        except Exception:
+            self.close()
+            raise
+
+
+class ChangeDetector(object):
+    #Compares thumbnails against the thumbnail of the last frame that was sent. A frame
+    #is sent when the mean absolute pixel difference reaches threshold, or when
+    #keyframe_interval seconds have passed since the last one
+
+    def __init__(self, threshold=4.0, keyframe_interval=1800):
+        self.threshold = threshold
+        self.keyframe_interval = keyframe_interval
+        self.reference = None
+        self.last_sent = 0
+        self.last_difference = None
+        REGISTRY.gauge('camera_frame_difference', "Mean pixel difference of the last compared frame", function=lambda: self.last_difference if self.last_difference is not None else float('nan'))
+
+    def difference(self, a, b):
+        if numpy is not None:
+            a = numpy.frombuffer(a, dtype=numpy.uint8).astype(numpy.int16)
+            b = numpy.frombuffer(b, dtype=numpy.uint8).astype(numpy.int16)
+            return float(numpy.abs(a - b).mean())
+        return sum(abs(x - y) for x, y in zip(a, b)) / float(len(a))
+
+    def should_send(self, thumbnail, now=None):
+        if now is None:
+            now = time.time()
+        keyframe = self.reference is None or len(self.reference) != len(thumbnail) or now - self.last_sent >= self.keyframe_interval
+        if not keyframe:
+            self.last_difference = self.difference(self.reference, thumbnail)
+            if self.last_difference < self.threshold:
+                FRAMES_SKIPPED.inc()
+                return False
+        self.reference = thumbnail
+        self.last_sent = now
+        FRAMES_SENT.inc()
+        return True
+
+
+class QualityController(object):
+    #Adapts the JPEG quality to the uplink: backs off multiplicatively when publishing
+    #takes longer than target_latency or images pile up unsent, and creeps back up otherwise.
+    #The quality handed to the camera moves in steps, every change restarts the
+    #camera's continuous capture
+
+    def __init__(self, quality=85, minimum=40, maximum=90, target_latency=2.0, max_backlog=1, step=5):
+        self.target = quality
+        self.minimum = minimum
+        self.maximum = maximum
+        self.target_latency = target_latency
+        self.max_backlog = max_backlog
+        self.step = step
+        self.quality = self.quantize(quality)
+
+    def quantize(self, quality):
+        return max(self.minimum, int(quality) // self.step * self.step)
+
+    def update(self, latency, backlog):
+        if latency > self.target_latency or backlog > self.max_backlog:
+            self.target = max(self.minimum, self.target * 0.8)
+        else:
+            self.target = min(self.maximum, self.target + 1)
+        self.quality = self.quantize(self.target)
+        logging.debug("publish took %.2fs, %d images pending, jpeg quality %d", latency, backlog, self.quality)
+        return self.quality
+
+
 class CameraReader(Thread):
 
-    def __init__(self, client, topic, identifier, interval=120, resolution=(2592, 1944)):
+    def __init__(self, client, topic, identifier, interval=120, resolution=(2592, 1944), image_format='binary', use_video_port=False, detector=None,
+                 preview_size=None, full_frame_every=1, quality=None, solar=None):
         super(CameraReader, self).__init__()
+        self.solar = solar if solar is not None else SolarSchedule()
+        self.detector = detector
+        #With a preview size every frame is sent as a preview, and only every
+        #full_frame_every'th frame, or a requested one, in full resolution
+        self.preview_size = preview_size
+        self.full_frame_every = full_frame_every
+        self.full_frame_requested = threading.Event()
+        self.quality = quality
+        self.pending = []
+        self.frames = 0
         self.interval = interval
         self.client = client
         self.topic = topic
         self.identifier = identifier
         self.resolution = resolution
-        self.suncache = None
-
-    def sundata(self):
-        now = datetime.datetime.now()
-        if(self.suncache is not None):
-            if (self.suncache.day >= now.day):
-                return
-
-        self.suncache = now
-        a = astral.Astral()
-        a.solar_depression = 'civil'
-        sun = a['Copenhagen'].sun(now,local=True)
-        self.dusk = sun['dusk']
-        self.dawn = sun['dawn']
-        self.sunrise = sun['sunrise']
-        self.sunset = sun['sunset']
+        self.image_format = image_format
+        self.use_video_port = use_video_port
+
+    def request_full_frame(self, client, userdata, msg):
+        logging.info("full resolution image requested")
+        self.full_frame_requested.set()
+
+    def publish(self, topic, data):
+        start = time.time()
+        info = self.client.publish(topic,data,0)
+        if self.quality is not None:
+            self.pending.append(info)
+            try:
+                info.wait_for_publish(self.quality.target_latency * 2)
+            except TypeError:
+                #paho before 1.6 has no timeout
+                info.wait_for_publish()
+            self.pending = [i for i in self.pending if not i.is_published()]
+            self.quality.update(time.time() - start, len(self.pending))
+
+    def send_binary(self, session, protocol):
+        quality = self.quality.quality if self.quality is not None else None
+        timestamp = datetime.datetime.now()
+        full = True
+        if self.preview_size is not None:
+            with CAMERA_CAPTURE_SECONDS.time():
+                data = session.capture_resized(protocol.new_image_header(self.identifier,timestamp,'preview'),self.preview_size,quality)
+            IMAGE_BYTES_CAPTURED.inc(len(data))
+            self.publish(self.topic + '/preview',data)
+            full = self.full_frame_requested.is_set() or (self.full_frame_every > 0 and self.frames % self.full_frame_every == 0)
+        self.frames += 1
+        if full:
+            self.full_frame_requested.clear()
+            #The camera appends the JPEG after the header, so the payload
+            #is built without any extra copies of the image
+            with CAMERA_CAPTURE_SECONDS.time():
+                data = session.capture(protocol.new_image_header(self.identifier,timestamp,'full'),quality)
+            IMAGE_BYTES_CAPTURED.inc(len(data))
+            logging.debug("publishing %d byte image", len(data))
+            self.publish(self.topic,data)
 
     def run(self):
         protocol = ThermometerProtocol()
-        while True:
-            try:
-                #pdb.set_trace()
-                camera = picamera.PiCamera()
-                camera.resolution = self.resolution
-                self.sundata()
-                now = datetime.datetime.now()
-                if(now.hour >= self.dawn.hour and now.hour <= self.dusk.hour):
-                    logging.info("capturing image")
-                    with io.BytesIO() as stream:
-                        camera.capture(stream,'jpeg')
-                        stream.seek(0)
-                        b64data = b64encode(stream.read())
-                        b64data = b64data.decode('ascii')
-                        data = protocol.new_image(self.identifier,b64data)
-                        logging.debug(data[:100])
-                        self.client.publish(self.topic,data,0)
-            except Exception as e:
-                logging.exception(e)
-            time.sleep(self.interval)
-
-
-class ThermometerReader(Thread):
-    def read_temp_raw(self,device):
-        f = open(device, 'r')
-        lines = f.readlines()
-        f.close()
-        return lines
-
-    def read_temp(self, device):
-        lines = self.read_temp_raw(device)
-        while lines[0].strip()[-3:] != 'YES':
-            time.sleep(0.2)
-            lines = self.read_temp_raw()
-        equals_pos = lines[1].find('t=')
-        if equals_pos != -1:
-            temp_string = lines[1][equals_pos+2:]
-            temp_c = float(temp_string) / 1000.0
-            temp_f = temp_c * 9.0 / 5.0 + 32.0
-            return temp_c, temp_f
-
-    def __init__(self, hostid, sensorId, device, interval=60, mqttClient=None, mqttTopic=None):
-        super(ThermometerReader, self).__init__()
-        self.device = device
-        self.interval = interval
+        with CameraSession(self.resolution, self.use_video_port) as session:
+            while True:
+                try:
+                    #pdb.set_trace()
+                    if self.solar.is_daylight():
+                        if self.detector is not None and not self.detector.should_send(session.capture_thumbnail()):
+                            logging.debug("scene unchanged, skipping frame, difference %s", self.detector.last_difference)
+                            time.sleep(self.interval)
+                            continue
+                        logging.info("capturing image")
+                        if self.image_format == 'binary':
+                            self.send_binary(session,protocol)
+                        else:
+                            with CAMERA_CAPTURE_SECONDS.time():
+                                image = session.capture()
+                            IMAGE_BYTES_CAPTURED.inc(len(image))
+                            b64data = b64encode(image)
+                            b64data = b64data.decode('ascii')
+                            data = protocol.new_image(self.identifier,b64data)
+                            logging.debug(data[:100])
+                            self.client.publish(self.topic,data,0)
+                    else:
+                        #No need to keep the camera running through the night
+                        session.close()
+                except Exception as e:
+                    logging.exception(e)
+                time.sleep(self.interval)
+
+
+class ReadingBatcher(object):
+    #Collects the readings of all sensors and publishes them as one message per window
+    #instead of one QoS 2 message per value. With aggregate every sensor is sent once per
+    #window as the mean of its samples, so sampling can be faster than transmitting
+
+    def __init__(self, mqttClient, mqttTopic, hostid, window=300, binary=False, aggregate=False):
         self.mqttClient = mqttClient
         self.mqttTopic = mqttTopic
-        self.sensorId = sensorId
         self.hostId = hostid
+        self.window = window
+        self.binary = binary
+        self.aggregate = aggregate
+        self.samples = []
+        self.started = time.monotonic()
+        self.lock = threading.Lock()
+        self.batches = 0
+
+    def add(self, sensor, reading, timestamp=None):
+        if timestamp is None:
+            timestamp = time.time()
+        with self.lock:
+            self.samples.append((sensor, timestamp, reading))
+
+    def rows(self, samples):
+        if not self.aggregate:
+            return ['reading'], [[s, int(t), r] for s, t, r in samples]
+        #The server stores one value per sensor and timestamp, the mean at the time
+        #of the last sample
+        stats = collections.OrderedDict()
+        for s, t, r in samples:
+            if s not in stats:
+                stats[s] = [t, 0.0, 0]
+            st = stats[s]
+            st[0] = t
+            st[1] += r
+            st[2] += 1
+        return ['reading'], [[s, int(st[0]), st[1] / st[2]] for s, st in stats.items()]
+
+    def poll(self):
+        #Publishes the batch once the window has passed
+        if time.monotonic() - self.started >= self.window:
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            samples = self.samples
+            self.samples = []
+            self.started = time.monotonic()
+        if not samples:
+            return
+        fields, rows = self.rows(samples)
+        protocol = ThermometerProtocol()
+        if self.binary:
+            payload = protocol.new_binary_reading_batch(self.hostId, fields, rows)
+        else:
+            payload = protocol.new_reading_batch(self.hostId, fields, rows)
+        logging.info("publishing batch of %d rows from %d samples (%d bytes)", len(rows), len(samples), len(payload))
+        self.mqttClient.publish(self.mqttTopic,payload,2)
+        self.batches += 1
+
+class ThermometerBusReader(Thread):
+    #Reads every DS18B20 from one thread on a fixed schedule. Where the kernel supports
+    #it, writing to therm_bulk_read starts the conversion on all sensors of a bus at
+    #once, so the reads that follow do not each wait ~750ms for their own conversion
+
+    def __init__(self, hostid, mqttClient=None, mqttTopic=None, interval=60, base_dir=base_dir, retries=3, conversion_timeout=1.5, batcher=None):
+        super(ThermometerBusReader, self).__init__()
         self.daemon = True
+        self.hostId = hostid
+        self.mqttClient = mqttClient
+        self.mqttTopic = mqttTopic
+        self.interval = interval
+        self.base_dir = base_dir
+        self.retries = retries
+        self.conversion_timeout = conversion_timeout
+        self.batcher = batcher
+        self.sensors = {}
+        self.reads = {}
+        self.errors = {}
+
+    def discover(self):
+        #Returns the sensors that were not known before
+        found = {}
+        for s in glob.glob(os.path.join(self.base_dir, '28*')):
+            found[os.path.basename(s)] = os.path.join(s, 'w1_slave')
+        new = [s for s in found if s not in self.sensors]
+        for s in new:
+            logging.debug("adding sensor %s (%s)" % (s,found[s]))
+            self.reads[s] = REGISTRY.counter('sensor_reads', "Reads of a 1-Wire sensor", {'sensor':s})
+            self.errors[s] = REGISTRY.counter('sensor_read_errors', "Sensor reads without a valid temperature", {'sensor':s})
+        self.sensors = found
+        return new
+
+    def trigger_conversion(self):
+        #Returns False when no bus master supports bulk conversion
+        masters = glob.glob(os.path.join(self.base_dir, 'w1_bus_master*', 'therm_bulk_read'))
+        if not masters:
+            return False
+        for m in masters:
+            with open(m, 'w') as f:
+                f.write('trigger\n')
+        #therm_bulk_read reads -1 while any sensor on the bus is still converting
+        deadline = time.monotonic() + self.conversion_timeout
+        for m in masters:
+            while time.monotonic() < deadline:
+                with open(m) as f:
+                    if f.read().strip() != '-1':
+                        break
+                time.sleep(0.05)
+        return True
+
+    def read_temp_raw(self, device):
+        with open(device, 'r') as f:
+            return f.readlines()
+
+    def read_temp(self, device):
+        #Returns the temperature in Celsius, or None when the CRC check keeps failing
+        for attempt in range(self.retries):
+            if attempt > 0:
+                time.sleep(0.2)
+            try:
+                lines = self.read_temp_raw(device)
+            except IOError as e:
+                logging.debug("reading %s failed: %s", device, e)
+                continue
+            if len(lines) < 2 or lines[0].strip()[-3:] != 'YES':
+                continue
+            equals_pos = lines[1].find('t=')
+            if equals_pos == -1:
+                continue
+            temp_c = float(lines[1][equals_pos+2:]) / 1000.0
+            #85C is the power-on value of a sensor that did not convert
+            if temp_c == 85.0:
+                continue
+            return temp_c
+        return None
+
+    def read_all(self):
+        #Returns the readings of all sensors as a dict sensor -> temperature
+        with BULK_CONVERSION_SECONDS.time():
+            self.trigger_conversion()
+        readings = {}
+        for s in sorted(self.sensors):
+            with SENSOR_READ_SECONDS.time():
+                temp = self.read_temp(self.sensors[s])
+            self.reads[s].inc()
+            if temp is None:
+                self.errors[s].inc()
+                logging.warning("no valid reading from %s (%d errors in %d reads)" % (s,self.errors[s].value,self.reads[s].value))
+                continue
+            readings[s] = temp
+        return readings
+
+    def publish(self, sensor, temp, timestamp):
+        self.mqttClient.publish(self.mqttTopic,ThermometerProtocol().new_reading(self.hostId,sensor,temp,timestamp),2)
 
     def run(self):
         protocol = ThermometerProtocol()
+        next_run = time.monotonic()
         while True:
-            temp = self.read_temp(self.device)[0]
-            logging.info("read %f from %s" % (temp,self.sensorId))
-            data = protocol.new_reading(self.hostId,self.sensorId,temp)
-            self.mqttClient.publish(self.mqttTopic,data,2)
-            time.sleep(self.interval)
+            try:
+                for s in self.discover():
+                    logging.info("registering sensor %s" % s)
+                    self.mqttClient.publish(self.mqttTopic,protocol.new_sensor(self.hostId,s),2)
+                now = time.time()
+                timestamp = str(datetime.datetime.fromtimestamp(now))
+                for s, temp in self.read_all().items():
+                    logging.info("read %f from %s", temp, s)
+                    if self.batcher is not None:
+                        self.batcher.add(s,temp,now)
+                    else:
+                        self.publish(s,temp,timestamp)
+                if self.batcher is not None:
+                    self.batcher.poll()
+            except Exception as e:
+                logging.exception(e)
+            #Runs at fixed times relative to the start, slow reads do not shift the schedule
+            #and missed runs are skipped instead of bunched up
+            next_run += self.interval
+            now = time.monotonic()
+            if next_run < now:
+                next_run += ((now - next_run) // self.interval + 1) * self.interval
+            time.sleep(next_run - now)
+
+class OutboxInfo(object):
+    #Stands in for paho's MQTTMessageInfo for messages that went through the outbox
+
+    def __init__(self):
+        self.published = threading.Event()
+
+    def is_published(self):
+        return self.published.is_set()
+
+    def wait_for_publish(self, timeout=None):
+        self.published.wait(timeout)
+
+class Outbox(Thread):
+    #Durable store-and-forward queue between the readers and the MQTT client. Every
+    #message is written to SQLite first and a drain thread publishes them oldest first,
+    #at most rate messages per second, while the broker is connected. A message is
+    #deleted once the broker has acknowledged it. The payload is stored as is, so the
+    #original timestamps are kept. When the outbox grows beyond max_bytes or
+    #max_messages, the oldest messages are evicted, or with evict='qos' the oldest
+    #of the lowest QoS first, which drops images before readings.
+    #paho keeps a QoS 1 or 2 message it was handed, also one published while it is
+    #disconnected or whose acknowledgement timed out, and delivers it after a
+    #reconnect. Such a message is left to paho instead of being published again,
+    #its row is deleted once paho reports it published. At most max_inflight
+    #messages are handed to paho at a time
+
+    def __init__(self, filename, client, max_bytes=64*1024*1024, max_messages=100000, rate=10, evict='oldest', publish_timeout=30, max_inflight=20):
+        super(Outbox, self).__init__()
+        self.daemon = True
+        self.client = client
+        self.max_bytes = max_bytes
+        self.max_messages = max_messages
+        self.rate = rate
+        self.evict_order = 'qos, id' if evict == 'qos' else 'id'
+        self.publish_timeout = publish_timeout
+        self.max_inflight = max_inflight
+        #rowid -> (paho message info, size) of the messages paho holds, only used
+        #by the drain thread
+        self.inflight = {}
+        self.connected = threading.Event()
+        self.pending = threading.Event()
+        self.lock = threading.Lock()
+        self.infos = {}
+        self.published = 0
+        self.evicted = 0
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS Outbox (id INTEGER PRIMARY KEY AUTOINCREMENT, topic TEXT NOT NULL, payload BLOB NOT NULL, qos INTEGER NOT NULL, size INTEGER NOT NULL)')
+        self.db.commit()
+        self.count, self.bytes = self.db.execute('SELECT COUNT(*), IFNULL(SUM(size), 0) FROM Outbox').fetchone()
+        if self.count:
+            logging.info("outbox holds %d messages (%d bytes) from a previous run" % (self.count,self.bytes))
+            self.pending.set()
+
+    def on_connect(self, client, userdata, flags, rc):
+        if rc == 0:
+            self.connected.set()
+
+    def on_disconnect(self, client, userdata, rc):
+        self.connected.clear()
+
+    def on_publish(self, client, userdata, mid):
+        #Wakes the drain thread to delete the rows of messages paho delivered
+        if self.inflight:
+            self.pending.set()
+
+    def publish(self, topic, payload, qos=0, retain=False):
+        if isinstance(payload, str):
+            payload = payload.encode('utf-8')
+        info = OutboxInfo()
+        with self.lock:
+            cursor = self.db.execute('INSERT INTO Outbox (topic, payload, qos, size) VALUES (?, ?, ?, ?)', (topic, sqlite3.Binary(payload), qos, len(payload)))
+            self.infos[cursor.lastrowid] = info
+            self.count += 1
+            self.bytes += len(payload)
+            self.evict()
+            self.db.commit()
+        self.pending.set()
+        return info
+
+    def evict(self):
+        while self.count > 1 and (self.count > self.max_messages or self.bytes > self.max_bytes):
+            rowid, size = self.db.execute('SELECT id, size FROM Outbox ORDER BY %s LIMIT 1' % self.evict_order).fetchone()
+            self.db.execute('DELETE FROM Outbox WHERE id = ?', (rowid,))
+            self.infos.pop(rowid, None)
+            self.count -= 1
+            self.bytes -= size
+            self.evicted += 1
+            logging.warning("outbox full, evicted message %d (%d bytes)" % (rowid,size))
+
+    def get_stats(self):
+        return {'messages':self.count, 'bytes':self.bytes, 'published':self.published, 'evicted':self.evicted, 'inflight':len(self.inflight)}
+
+    def send(self, rowid, topic, payload, qos):
+        #Returns True once the broker has the message
+        info = self.client.publish(topic, bytes(payload), qos)
+        if info.rc == paho.MQTT_ERR_NO_CONN and qos > 0:
+            #Queued by paho, which sends it once it is connected again
+            self.inflight[rowid] = (info, len(payload))
+            return False
+        if info.rc != paho.MQTT_ERR_SUCCESS:
+            #Not taken, e.g. MQTT_ERR_QUEUE_SIZE, or QoS 0 while disconnected
+            return False
+        if qos > 0:
+            self.inflight[rowid] = (info, len(payload))
+        try:
+            info.wait_for_publish(self.publish_timeout)
+        except TypeError:
+            #paho before 1.6 has no timeout
+            info.wait_for_publish()
+        if not info.is_published():
+            return False
+        self.delivered(rowid, len(payload))
+        return True
+
+    def reap(self):
+        #Deletes the rows of held messages paho has delivered since
+        for rowid, (info, size) in list(self.inflight.items()):
+            if info.is_published():
+                self.delivered(rowid, size)
+
+    def delivered(self, rowid, size):
+        self.inflight.pop(rowid, None)
+        with self.lock:
+            deleted = self.db.execute('DELETE FROM Outbox WHERE id = ?', (rowid,)).rowcount
+            self.db.commit()
+            #The message may have been evicted while it was being sent, evict()
+            #has then already taken it off the counts
+            if deleted == 1:
+                self.count -= 1
+                self.bytes -= size
+            self.published += 1
+            done = self.infos.pop(rowid, None)
+        if done is not None:
+            done.published.set()
+
+    def run(self):
+        while True:
+            self.pending.wait()
+            self.connected.wait()
+            self.pending.clear()
+            self.reap()
+            limit = min(max(1, int(self.rate)), self.max_inflight - len(self.inflight))
+            if limit <= 0:
+                #Woken by on_publish
+                continue
+            with self.lock:
+                rows = self.db.execute('SELECT id, topic, payload, qos FROM Outbox ORDER BY id LIMIT ?', (limit + len(self.inflight),)).fetchall()
+            rows = [r for r in rows if r[0] not in self.inflight][:limit]
+            if not rows:
+                continue
+            #Anything left over is picked up by the next round
+            self.pending.set()
+            start = time.monotonic()
+            try:
+                for rowid, topic, payload, qos in rows:
+                    if not self.send(rowid, topic, payload, qos):
+                        if rowid in self.inflight:
+                            logging.info("broker did not acknowledge outbox message %d yet, paho delivers it after reconnect" % rowid)
+                        else:
+                            logging.info("broker did not take outbox message %d, retrying after reconnect" % rowid)
+                        time.sleep(1)
+                        break
+            except Exception as e:
+                logging.exception(e)
+                time.sleep(1)
+            time.sleep(max(0.0, len(rows) / float(self.rate) - (time.monotonic() - start)))
 
 class ThermometerClient(object):
 
@@ -148,12 +723,38 @@ class ThermometerClient(object):
         ap.add_argument('-i','--identifier',help="Local identifier to send to server", default='test')
         ap.add_argument('-v', help="Increase log level, can be specified multiple times", action='count', default=1)
         ap.add_argument('-t','--topic',help="topic postfix to append after /surveillance/<type>/")
+        ap.add_argument('--interval',help="Seconds between temperature readings", type=float, default=60)
+        ap.add_argument('--batch-window',help="Publish readings in one message per this many seconds, 0 publishes every reading", type=float, default=0)
+        ap.add_argument('--batch-format',help="Format of reading batches", choices=['json','binary'], default='json')
+        ap.add_argument('--batch-aggregate',help="Send the mean per sensor and window instead of every sample", action='store_true')
+        ap.add_argument('--outbox',help="SQLite file to queue messages in until the broker has them, disabled if not given")
+        ap.add_argument('--outbox-max-mb',help="Maximum size of the queued messages in MB", type=float, default=64)
+        ap.add_argument('--outbox-max-messages',help="Maximum number of queued messages", type=int, default=100000)
+        ap.add_argument('--outbox-rate',help="Messages per second to send from the outbox", type=float, default=10)
+        ap.add_argument('--outbox-evict',help="Which messages to drop when the outbox is full, oldest or the oldest of the lowest QoS (images)", choices=['oldest','qos'], default='oldest')
+        ap.add_argument('--metrics-port',help="Serve metrics in Prometheus text format on this port", type=int)
+        ap.add_argument('--metrics-bind',help="Address to bind the metrics HTTP server to", default='127.0.0.1')
+        ap.add_argument('--metrics-interval',help="Publish the metrics to /surveillance/stats/<identifier> every this many seconds, 0 disables", type=int, default=0)
+        ap.add_argument('--w1-dir',help="Directory of the 1-Wire devices", default=base_dir)
+        ap.add_argument('--latitude',help="Latitude of the camera, images are taken from dawn to dusk", type=float, default=55.6761)
+        ap.add_argument('--longitude',help="Longitude of the camera", type=float, default=12.5683)
+        ap.add_argument('--solar-cache',help="Directory the precomputed dawn and dusk times are kept in", default=os.path.expanduser('~/.cache/rpi_surveillance'))
+        ap.add_argument('--camera-interval',help="Seconds between camera captures", type=float, default=120)
+        ap.add_argument('--camera-video-port',help="Capture through the camera video port, faster but lower quality", action='store_true')
+        ap.add_argument('--motion-threshold',help="Only send images when the mean pixel difference to the last sent image reaches this value (0-255)", type=float)
+        ap.add_argument('--keyframe-interval',help="With --motion-threshold, send an image at least this often in seconds", type=float, default=1800)
+        ap.add_argument('--preview-size',help="Also send every image as a preview of this size, e.g. 640x480", type=lambda v: tuple(int(x) for x in v.split('x')))
+        ap.add_argument('--full-frame-every',help="With --preview-size, send every n'th image in full resolution, 0 only sends them on request", type=int, default=1)
+        ap.add_argument('--adaptive-quality',help="Adapt the JPEG quality to how fast images are published", action='store_true')
+        ap.add_argument('--image-format',help="Send images as raw JPEG (binary) or as legacy base64 encoded JSON", choices=['binary','json'], default='binary')
         args = ap.parse_args()
         return args
 
     def connect(self, args):
         client = paho.Client()
-        client.connect(args.host, args.port, 60)
+        #Connects in the background and keeps retrying, so a missing broker at
+        #startup does not stop the readers
+        client.connect_async(args.host, args.port, 60)
         return client
 
     def dump_args(self, args):
@@ -164,8 +765,8 @@ class ThermometerClient(object):
                 logging.info("--%s = %s" % (a,ardict[a]))
 
     def main(self):
-        #os.system('modprobe w1-gpio')
-        #os.system('modprobe w1-therm')
+        os.system('modprobe w1-gpio')
+        os.system('modprobe w1-therm')
         args = self.get_args()
         loglevel = logging.WARNING
         if args.v == 2:
@@ -177,30 +778,55 @@ class ThermometerClient(object):
         logging.basicConfig(format='%(asctime)s %(levelname)s: %(message)s', level=loglevel)
         self.dump_args(args)
 
-        self.base_dir = '/sys/bus/w1/devices/'
-        sensors = self.device_folder = glob.glob(base_dir + '28*')
-        sensor_files = dict()
-        for s in sensors:
-            logging.debug("adding sensor %s (%s)" % (os.path.basename(s),os.path.join(s,'w1_slave')))
-            sensor_files[os.path.basename(s)] = os.path.join(s,'w1_slave')
-
-
         temperature_topic = "/surveillance/temperature/%s/%s" % (args.topic,args.identifier)
-        surveillance_topic = "/surveillance/image/%s" % args.identifier
+        if args.image_format == 'binary':
+            surveillance_topic = "/surveillance/imagebin/%s" % args.identifier
+        else:
+            surveillance_topic = "/surveillance/image/%s" % args.identifier
         protocol = ThermometerProtocol()
         client = self.connect(args)
-        client.loop_start()
+        publisher = client
+        outbox = None
+        if args.outbox is not None:
+            outbox = Outbox(args.outbox,client,int(args.outbox_max_mb*1024*1024),args.outbox_max_messages,args.outbox_rate,args.outbox_evict)
+            client.on_disconnect = outbox.on_disconnect
+            client.on_publish = outbox.on_publish
+            publisher = outbox
+            outbox.start()
+            REGISTRY.gauge('outbox_messages', "Messages waiting in the outbox", function=lambda: outbox.count)
+            REGISTRY.gauge('outbox_bytes', "Bytes waiting in the outbox", function=lambda: outbox.bytes)
+        if args.metrics_port is not None:
+            MetricsServer(args.metrics_bind, args.metrics_port).start()
+        if args.metrics_interval > 0:
+            MetricsPublisher(client, "/surveillance/stats/%s" % args.identifier, args.metrics_interval).start()
 
         reader_threads = []
-        for s in sensor_files:
-            logging.info("Starting thread for sensor %s" % s)
-            t = ThermometerReader(args.identifier,s,sensor_files[s],60,client,temperature_topic)
-            client.publish(temperature_topic,protocol.new_sensor(args.identifier,s),2)
-            reader_threads.append(t)
-            t.start()
+        batcher = None
+        if args.batch_window > 0:
+            batch_topic = temperature_topic
+            if args.batch_format == 'binary':
+                batch_topic = "/surveillance/readingbin/%s" % args.identifier
+            batcher = ReadingBatcher(publisher,batch_topic,args.identifier,args.batch_window,args.batch_format == 'binary',args.batch_aggregate)
+        t = ThermometerBusReader(args.identifier,publisher,temperature_topic,args.interval,args.w1_dir,batcher=batcher)
+        reader_threads.append(t)
+        t.start()
 
         #Start camera if module is present
-        t = CameraReader(client,surveillance_topic,args.identifier)
+        detector = None
+        if args.motion_threshold is not None:
+            detector = ChangeDetector(args.motion_threshold, args.keyframe_interval)
+        quality = QualityController() if args.adaptive_quality else None
+        t = CameraReader(publisher,surveillance_topic,args.identifier,args.camera_interval,image_format=args.image_format,use_video_port=args.camera_video_port,detector=detector,
+                         preview_size=args.preview_size,full_frame_every=args.full_frame_every,quality=quality,
+                         solar=SolarSchedule(args.latitude,args.longitude,args.solar_cache))
+        request_topic = "/surveillance/request/%s/fullframe" % args.identifier
+        client.message_callback_add(request_topic,t.request_full_frame)
+        def on_connect(client, userdata, flags, rc):
+            client.subscribe(request_topic,1)
+            if outbox is not None:
+                outbox.on_connect(client,userdata,flags,rc)
+        client.on_connect = on_connect
+        client.loop_start()
         reader_threads.append(t)
         t.start()
 
@@ -208,6 +834,10 @@ class ThermometerClient(object):
             while threading.active_count() > 0:
                 time.sleep(60)
         finally:
+            if batcher is not None:
+                batcher.flush()
+            if outbox is not None:
+                logging.info("outbox: %s" % outbox.get_stats())
             client.loop_stop()
             client.disconnect()
 
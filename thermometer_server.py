@@ -2,36 +2,239 @@
 # -*- coding: utf-8 -*-
 
 import os
+import re
 import sys
 #import pdb
 import json
+import math
 import time
+import zlib
+import signal
 import shlex
-import astral
+import array
+import shutil
+import hashlib
+import collections
+import http.server
+import urllib.parse
+import struct
 from base64 import b64decode
+import queue
+import heapq
 import sqlite3
 import logging
 import rrdtool
 import argparse
 import datetime
 import subprocess
+import multiprocessing
+import concurrent.futures
 from threading import Thread
+import threading
 import paho.mqtt.client as paho
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
+from solar_schedule import SolarSchedule
+from metrics import REGISTRY, MetricsServer, MetricsPublisher
+
+# Binary image messages are the magic, a 2 byte big endian header length, a
+# small JSON header with the metadata and then the raw JPEG bytes.
+IMAGE_HEADER_MAGIC = b'RPSI'
+BINARY_IMAGE_TOPIC = '/surveillance/imagebin/'
+IMAGE_TOPIC = '/surveillance/image/'
+TEMPERATURE_TOPIC = '/surveillance/temperature/'
+# Binary reading batches use the same layout with their own magic. The header
+# names the sensors and the value fields, followed by fixed size rows of a one
+# byte sensor index, a 4 byte epoch and one float per field.
+READING_BATCH_MAGIC = b'RPSB'
+BINARY_READING_TOPIC = '/surveillance/readingbin/'
+# Ingest processes share the database file, a connection waits this many seconds
+# for another process' transaction before it gives up
+DB_BUSY_TIMEOUT = 30
+
+MESSAGES_RECEIVED = REGISTRY.counter('mqtt_messages_received', "Messages received from the broker")
+MESSAGE_ERRORS = REGISTRY.counter('mqtt_message_errors', "Messages that could not be parsed or queued")
+RECEIVE_SECONDS = REGISTRY.histogram('mqtt_receive_seconds', "Time on_message spends on a message in the network thread")
+PARSE_SECONDS = REGISTRY.histogram('message_parse_seconds', "Time to decode a JSON or binary reading message")
+READINGS_PROCESSED = REGISTRY.counter('readings_processed', "Readings stored and sent to RRD")
+DB_WRITE_SECONDS = REGISTRY.histogram('db_write_seconds', "Time to commit one batch of database writes")
+DB_ROWS_WRITTEN = REGISTRY.counter('db_rows_written', "Rows written by the database writer")
+RRD_UPDATE_SECONDS = REGISTRY.histogram('rrd_update_seconds', "Time to write the buffered updates of one RRD file")
+RRD_UPDATES = REGISTRY.counter('rrd_updates', "Readings buffered for an RRD file")
+RRD_WRITES = REGISTRY.counter('rrd_writes', "rrdtool update calls")
+RRD_UPDATE_ERRORS = REGISTRY.counter('rrd_update_errors', "RRD updates rrdtool rejected")
+IMAGE_WRITE_SECONDS = REGISTRY.histogram('image_write_seconds', "Time to store one image")
+IMAGE_BYTES_WRITTEN = REGISTRY.counter('image_bytes_written', "Bytes of images stored")
+GRAPH_RENDER_SECONDS = REGISTRY.histogram('graph_render_seconds', "Time to render one RRD graph")
+GRAPH_CACHE_HITS = REGISTRY.counter('graph_cache_hits', "Graph requests answered from the graph cache")
+GRAPH_CACHE_MISSES = REGISTRY.counter('graph_cache_misses', "Graph requests that had to be rendered")
+GRAPH_NOT_MODIFIED = REGISTRY.counter('graph_not_modified', "Graph requests answered with 304 Not Modified")
+TIMELAPSE_ENCODE_SECONDS = REGISTRY.histogram('timelapse_encode_seconds', "Time to encode one timelapse video")
+SHARD_MESSAGES_SKIPPED = REGISTRY.counter('shard_messages_skipped', "Messages left to the ingest process owning their host")
+
+
+def compile_schema(fields):
+    #Returns a validator for a message body with the given (name, types) fields,
+    #a missing field is None and only passes when NoneType is allowed
+    fields = tuple((name, types if isinstance(types, tuple) else (types,)) for name, types in fields)
+    def validate(data):
+        if not isinstance(data, dict):
+            raise ValueError("message body is not an object")
+        for name, types in fields:
+            if not isinstance(data.get(name), types):
+                raise ValueError("field %s is missing or not %s" % (name, '/'.join(t.__name__ for t in types)))
+        return data
+    return validate
+
+
+def to_epoch(timestamp):
+    #Client timestamps are str(datetime.datetime.now()), i.e. local time
+    if timestamp is None:
+        return int(time.time())
+    if isinstance(timestamp, (int, float)):
+        return int(timestamp)
+    if not isinstance(timestamp, datetime.datetime):
+        if timestamp.isdigit():
+            return int(timestamp)
+        timestamp = datetime.datetime.fromisoformat(timestamp)
+    return int(timestamp.timestamp())
+
+def day_range(date):
+    #Epoch range [start, end) covering a local YYYY-MM-DD date
+    start = datetime.datetime.strptime(date, '%Y-%m-%d')
+    end = start + datetime.timedelta(days=1)
+    return int(start.timestamp()), int(end.timestamp())
+
+class DatabaseWriter(Thread):
+    #Write-behind queue for SurveillanceDatabase. Statements are grouped into a single
+    #transaction which is committed every batch_size rows or batch_interval ms,
+    #whichever comes first, so an SD card sees one fsync per batch instead of one per message
+
+    def __init__(self, filename, batch_size=100, batch_interval=1000, synchronous='NORMAL'):
+        super(DatabaseWriter, self).__init__()
+        self.daemon = True
+        self.filename = filename
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval / 1000.0
+        self.synchronous = synchronous
+        self.queue = queue.Queue()
+        self.flushes = 0
+        self.rows = 0
+        self.errors = 0
+        self.last_flush_latency = 0.0
+        self.max_flush_latency = 0.0
+
+    def put(self, statement, params):
+        self.queue.put((statement, params))
+
+    def flush(self):
+        #Blocks until everything queued before the call has been committed
+        done = threading.Event()
+        self.queue.put((None, done))
+        done.wait()
+
+    def stop(self):
+        self.queue.put((None, None))
+        self.join()
+
+    def get_stats(self):
+        return {'queue_depth':self.queue.qsize(),
+                'flushes':self.flushes,
+                'rows':self.rows,
+                'errors':self.errors,
+                'last_flush_ms':self.last_flush_latency * 1000.0,
+                'max_flush_ms':self.max_flush_latency * 1000.0}
+
+    def write_batch(self, conn, batch):
+        start = time.time()
+        try:
+            with conn:
+                for statement, params in batch:
+                    conn.execute(statement, params)
+        except sqlite3.Error as e:
+            #One bad row must not take the rest of the batch with it, retry them one by one
+            logging.exception(e)
+            for statement, params in batch:
+                try:
+                    with conn:
+                        conn.execute(statement, params)
+                except sqlite3.Error as e:
+                    self.errors += 1
+                    logging.error("dropping database write %s %s: %s" % (statement, params, e))
+        latency = time.time() - start
+        DB_WRITE_SECONDS.observe(latency)
+        DB_ROWS_WRITTEN.inc(len(batch))
+        self.flushes += 1
+        self.rows += len(batch)
+        self.last_flush_latency = latency
+        self.max_flush_latency = max(self.max_flush_latency, latency)
+        logging.debug("flushed %d rows in %.1f ms, %d queued", len(batch), latency * 1000.0, self.queue.qsize())
+
+    def run(self):
+        conn = sqlite3.connect(self.filename, DB_BUSY_TIMEOUT)
+        conn.execute("PRAGMA synchronous=%s" % self.synchronous)
+        batch = []
+        waiters = []
+        deadline = None
+        running = True
+        while running:
+            timeout = None
+            if deadline is not None:
+                timeout = max(0, deadline - time.time())
+            try:
+                statement, params = self.queue.get(timeout=timeout)
+                if statement is not None:
+                    batch.append((statement, params))
+                    if deadline is None:
+                        deadline = time.time() + self.batch_interval
+                elif params is None:
+                    running = False
+                else:
+                    waiters.append(params)
+            except queue.Empty:
+                pass
+
+            if batch and (len(batch) >= self.batch_size or waiters or not running or time.time() >= deadline):
+                self.write_batch(conn, batch)
+                batch = []
+                deadline = None
+            for w in waiters:
+                w.set()
+            waiters = []
+        conn.close()
 
 
 class SurveillanceDatabase(object):
-    _version = "1"
+    #Schema version, stored in PRAGMA user_version. Version 1 databases report 0
+    _version = "3"
     _dbname = None
-    _dbobject = None
     _instance = None
+    _writer = None
+    _synchronous = 'NORMAL'
+
+    #Timestamps are stored as integer epoch seconds
+    _readings_table = 'CREATE TABLE %s(id INTEGER PRIMARY KEY,host TEXT NOT NULL, sensorId TEXT NOT NULL, timestamp INTEGER NOT NULL, reading TEXT)'
+    _surveillance_table = 'CREATE TABLE %s(id INTEGER PRIMARY KEY, host TEXT NOT NULL, timestamp INTEGER NOT NULL, imageLink TEXT NOT NULL, rendition TEXT NOT NULL DEFAULT \'full\')'
+    _readings_indexes = [
+        'CREATE INDEX ReadingsHostTimeIdx ON Readings(host,timestamp,sensorId,reading)'
+    ]
+    _surveillance_indexes = [
+        'CREATE UNIQUE INDEX SurveillanceIdx ON Surveillance(imageLink)',
+        'CREATE INDEX SurveillanceHostTimeIdx ON Surveillance(host,timestamp,rendition,imageLink)'
+    ]
 
     _ddl = [
         'CREATE TABLE Sensors(id INTEGER PRIMARY KEY, host TEXT NOT NULL, sensor TEXT NOT NULL, alias TEXT, rrdGraph INTEGER DEFAULT 0, last_update INTEGER)',
         'CREATE UNIQUE INDEX SensorsIdx ON Sensors(host,sensor)',
-        'CREATE TABLE Readings(id INTEGER PRIMARY KEY,host TEXT NOT NULL, sensorId TEXT NOT NULL, timestamp TEXT NOT NULL, reading TEXT)',
-        'CREATE TABLE Surveillance(id INTEGER PRIMARY KEY, host TEXT NOT NULL, timestamp TEXT NOT NULL, imageLink TEXT NOT NULL)',
-        'CREATE UNIQUE INDEX SurveillanceIdx ON Surveillance(imageLink)'
-    ]
+        _readings_table % 'Readings',
+        _surveillance_table % 'Surveillance'
+    ] + _readings_indexes + _surveillance_indexes
+
+    def __init__(self):
+        self._local = threading.local()
 
     @classmethod
     def get_instance(cls):
@@ -39,41 +242,160 @@ class SurveillanceDatabase(object):
             cls._instance = cls()
         return cls._instance
 
-    def open(self, filename):
+    @property
+    def _dbobject(self):
+        #SQLite connections can only be used by the thread that created them, so
+        #every thread using the database gets its own connection
+        conn = getattr(self._local, 'conn', None)
+        if conn is None and self._dbname is not None:
+            conn = sqlite3.connect(self._dbname, DB_BUSY_TIMEOUT)
+            conn.execute("PRAGMA synchronous=%s" % self._synchronous)
+            self._local.conn = conn
+        return conn
+
+    @_dbobject.setter
+    def _dbobject(self, conn):
+        self._local.conn = conn
+
+    def open(self, filename, batch_size=0, batch_interval=1000, synchronous='NORMAL', chunk_size=10000):
+        #batch_size 0 commits every write immediately, anything else queues writes
+        #in a DatabaseWriter which commits them in batches
         self._dbname = filename
+        self._synchronous = synchronous
         try:
-            self._dbobject = sqlite3.connect(filename)
             cur = self._dbobject.cursor()
+            cur.execute("PRAGMA journal_mode=WAL")
             cur.execute("SELECT count(*) FROM sqlite_master WHERE type='table' AND name='Readings'")
             row = cur.fetchone()
             if row[0] == 0:
                 for s in self._ddl:
                     logging.debug(s)
                     cur.execute(s)
+                cur.execute("PRAGMA user_version=%d" % int(self._version))
                 self._dbobject.commit()
             cur.close()
+            self.migrate(chunk_size)
+            if batch_size > 0:
+                self._writer = DatabaseWriter(filename, batch_size, batch_interval, synchronous)
+                self._writer.start()
             return self
         except Exception as e:
             logging.exception(e)
             sys.exit(-1)
 
     def __del__(self):
-        if self._dbobject is not None:
-            self._dbobject.close()
-        self._dbobject = None
+        if getattr(self._local, 'conn', None) is not None:
+            self._local.conn.close()
+        self._local.conn = None
 
-    def insert_reading(self, host, sensorId, timestamp, reading):
+    def get_schema_version(self):
+        cur = self._dbobject.cursor()
+        cur.execute("PRAGMA user_version")
+        version = cur.fetchone()[0]
+        cur.close()
+        return max(version, 1)
+
+    def migrate(self, chunk_size=10000):
+        version = self.get_schema_version()
+        if version >= int(self._version):
+            return
+        logging.info("migrating database %s from schema version %d to %s" % (self._dbname, version, self._version))
+        if version < 2:
+            self._migrate_table('Readings', ['id','host','sensorId','timestamp','reading'], 3, self._readings_table, self._readings_indexes, chunk_size)
+            self._migrate_table('Surveillance', ['id','host','timestamp','imageLink'], 2, self._surveillance_table, self._surveillance_indexes, chunk_size)
         cur = self._dbobject.cursor()
-        cur.execute("INSERT INTO Readings(host, sensorId, timestamp, reading) VALUES(?, ?, ?, ?)", (host, sensorId,timestamp,reading))
+        if version < 3:
+            cur.execute("PRAGMA table_info(Surveillance)")
+            if 'rendition' not in [r[1] for r in cur.fetchall()]:
+                cur.execute("ALTER TABLE Surveillance ADD COLUMN rendition TEXT NOT NULL DEFAULT 'full'")
+                cur.execute("DROP INDEX SurveillanceHostTimeIdx")
+                cur.execute(self._surveillance_indexes[1])
+        cur.execute("PRAGMA user_version=%d" % int(self._version))
         self._dbobject.commit()
         cur.close()
+        logging.info("database migration done")
+
+    def _migrate_table(self, table, columns, timestamp_column, ddl, indexes, chunk_size):
+        #Copies the table into a new one in chunks, converting timestamps to epoch seconds.
+        #Every chunk is committed, so an interrupted migration resumes where it stopped
+        new_table = table + '_migrate'
+        cols = ','.join(columns)
+        cur = self._dbobject.cursor()
+        cur.execute("SELECT count(*) FROM sqlite_master WHERE type='table' AND name=?", (new_table,))
+        if cur.fetchone()[0] == 0:
+            cur.execute(ddl % new_table)
+            self._dbobject.commit()
+        cur.execute("SELECT coalesce(max(id),0) FROM %s" % new_table)
+        last = cur.fetchone()[0]
+        copied = 0
+        while True:
+            cur.execute("SELECT %s FROM %s WHERE id > ? ORDER BY id LIMIT ?" % (cols,table), (last,chunk_size))
+            rows = cur.fetchall()
+            if not rows:
+                break
+            converted = []
+            for r in rows:
+                r = list(r)
+                try:
+                    r[timestamp_column] = to_epoch(r[timestamp_column])
+                except Exception as e:
+                    logging.warning("%s row %d has invalid timestamp %s: %s" % (table,r[0],r[timestamp_column],e))
+                    r[timestamp_column] = 0
+                converted.append(r)
+            cur.executemany("INSERT INTO %s(%s) VALUES(%s)" % (new_table,cols,','.join('?'*len(columns))), converted)
+            self._dbobject.commit()
+            last = rows[-1][0]
+            copied += len(rows)
+            logging.info("migrated %d rows of %s" % (copied,table))
+        #sqlite3 does not open a transaction for DDL by itself, without the explicit
+        #BEGIN a crash between the DROP and the RENAME would leave no table at all
+        cur.execute("BEGIN")
+        try:
+            cur.execute("DROP TABLE %s" % table)
+            cur.execute("ALTER TABLE %s RENAME TO %s" % (new_table,table))
+            for s in indexes:
+                logging.debug(s)
+                cur.execute(s)
+            self._dbobject.commit()
+        except Exception:
+            self._dbobject.rollback()
+            raise
+        finally:
+            cur.close()
 
-    def insert_surveillance(self, host, imageLink, timestamp):
+    def close(self):
+        if self._writer is not None:
+            self._writer.stop()
+            self._writer = None
+        if getattr(self._local, 'conn', None) is not None:
+            self._local.conn.close()
+        self._local.conn = None
+        self._dbname = None
+
+    def flush(self):
+        if self._writer is not None:
+            self._writer.flush()
+
+    def get_stats(self):
+        if self._writer is not None:
+            return self._writer.get_stats()
+        return {}
+
+    def _write(self, statement, params):
+        if self._writer is not None:
+            self._writer.put(statement, params)
+            return
         cur = self._dbobject.cursor()
-        cur.execute("INSERT INTO Surveillance(host,timestamp,imageLink) VALUES(?, ?, ?)", (host,timestamp,imageLink))
+        cur.execute(statement, params)
         self._dbobject.commit()
         cur.close()
 
+    def insert_reading(self, host, sensorId, timestamp, reading):
+        self._write("INSERT INTO Readings(host, sensorId, timestamp, reading) VALUES(?, ?, ?, ?)", (host, sensorId,to_epoch(timestamp),reading))
+
+    def insert_surveillance(self, host, imageLink, timestamp, rendition='full'):
+        self._write("INSERT INTO Surveillance(host,timestamp,imageLink,rendition) VALUES(?, ?, ?, ?)", (host,to_epoch(timestamp),imageLink,rendition))
+
     def get_sensor(self, host, sensor):
         cur = self._dbobject.cursor()
         cur.execute("SELECT id FROM Sensors where host = ? and sensor = ?", (host,sensor))
@@ -115,23 +437,27 @@ class SurveillanceDatabase(object):
         return ret
 
     def register_sensor(self, host, sensor):
-        cur = self._dbobject.cursor()
-        cur.execute("INSERT INTO Sensors(host,sensor) VALUES(?,?)", (host,sensor))
-        self._dbobject.commit()
-        cur.close()
+        #OR IGNORE, a queued registration may not be visible to get_sensor yet
+        self._write("INSERT OR IGNORE INTO Sensors(host,sensor) VALUES(?,?)", (host,sensor))
 
     def get_surveillance_dates_iter(self, host):
+        #Every date before today, as a range scan over SurveillanceHostTimeIdx
+        today = day_range(datetime.date.today().isoformat())[0]
         cur = self._dbobject.cursor()
-        cur.execute("SELECT DISTINCT DATE(timestamp) FROM Surveillance WHERE DATE(timestamp) <= DATE('now','-1 day')")
+        cur.execute("SELECT DISTINCT DATE(timestamp,'unixepoch','localtime') FROM Surveillance WHERE host=? AND timestamp < ?", (host,today))
         r = cur.fetchone()
         while r is not None:
             yield r
             r = cur.fetchone()
         cur.close()
 
-    def get_surveillance_files_for_date(self,date,host):
+    def get_surveillance_files_for_date(self,date,host,rendition=None):
         cur = self._dbobject.cursor()
-        cur.execute("SELECT imageLink from Surveillance WHERE DATE(timestamp) = ? AND host=?", (date,host))
+        start, end = day_range(date)
+        if rendition is None:
+            cur.execute("SELECT imageLink from Surveillance WHERE host=? AND timestamp >= ? AND timestamp < ? ORDER BY timestamp", (host,start,end))
+        else:
+            cur.execute("SELECT imageLink from Surveillance WHERE host=? AND timestamp >= ? AND timestamp < ? AND rendition=? ORDER BY timestamp", (host,start,end,rendition))
 
         r = cur.fetchall()
         cur.close()
@@ -147,29 +473,381 @@ class SurveillanceDatabase(object):
         cur.close()
 
     def delete_surveillance_files(self,host,date):
-        cur = self._dbobject.cursor()
-        cur.execute("DELETE FROM Surveillance WHERE DATE(timestamp) = ? AND host=?",(date,host))
-        self._dbobject.commit()
-        cur.close()
+        start, end = day_range(date)
+        self._write("DELETE FROM Surveillance WHERE host=? AND timestamp >= ? AND timestamp < ?",(host,start,end))
 
     def update_last_update(self,host,sensor,date):
-        cur = self._dbobject.cursor()
-        cur.execute("UPDATE Sensors SET last_update=? WHERE host=? AND sensor=?",(date,host,sensor))
-        self._dbobject.commit()
-        cur.close()
+        self._write("UPDATE Sensors SET last_update=? WHERE host=? AND sensor=?",(date,host,sensor))
 
-    def check_last_update(self,max_time=600):
-        cur = self._dbobject.cursor()
-        cur.execute("SELECT host,sensor,last_update FROM sensors where last_update < ?",(int(time.time()-max_time),))
-        rows = cur.fetchall()
-        cur.close()
-        return rows
+    def set_sensor_alias(self, host, sensor, alias):
+        self._write("UPDATE Sensors SET alias=? WHERE host=? AND sensor=?",(alias,host,sensor))
 
-    def update_notification_sent(self, host, sensor, value=1):
+    def get_sensors_iter(self):
         cur = self._dbobject.cursor()
-        cur.execute("UPDATE Sensors SET notification_sent=? WHERE host=? AND sensor=?",(value,host,sensor))
+        cur.execute("SELECT id,host,sensor,alias,rrdGraph,last_update FROM Sensors ORDER BY id")
+        r = cur.fetchone()
+        while r is not None:
+            yield r
+            r = cur.fetchone()
         cur.close()
 
+class SensorInfo(object):
+    __slots__ = ('id', 'host', 'sensor', 'alias', 'rrdGraph', 'last_update', 'rrdfile')
+
+    def __init__(self, id, host, sensor, alias, rrdGraph, last_update, rrdfile):
+        self.id = id
+        self.host = host
+        self.sensor = sensor
+        self.alias = alias
+        self.rrdGraph = rrdGraph
+        self.last_update = last_update
+        self.rrdfile = rrdfile
+
+    @property
+    def name(self):
+        return self.alias if self.alias is not None else self.sensor
+
+class SensorRegistry(object):
+    #In memory copy of the Sensors table, so a reading needs no SQL. All sensors are
+    #loaded at startup, registrations and alias changes are written through to the
+    #database, and last_update is only kept in memory and written for all changed
+    #sensors at once every flush_interval seconds
+
+    def __init__(self, database, rrdPath, flush_interval=60):
+        self.database = database
+        self.rrdPath = rrdPath
+        self.flush_interval = flush_interval
+        self.sensors = {}
+        self.dirty = set()
+        self.listeners = []
+        self.last_flush = time.monotonic()
+        self.lock = threading.Lock()
+
+    def rrd_filename(self, host, sensor):
+        return os.path.join(self.rrdPath,"%s_%s_temperature.rrd" % (host,sensor))
+
+    def load(self):
+        #Also picks up rrdGraph and alias changes made directly in the database,
+        #known sensors are updated in place and keep their in memory last_update
+        changed = []
+        with self.lock:
+            sensors = dict(self.sensors)
+            for id, host, sensor, alias, rrdGraph, last_update in self.database.get_sensors_iter():
+                info = sensors.get((host, sensor))
+                if info is None:
+                    sensors[(host, sensor)] = SensorInfo(id, host, sensor, alias, rrdGraph, last_update, self.rrd_filename(host, sensor))
+                    continue
+                if info.alias != alias:
+                    info.alias = alias
+                    changed.append((host, sensor))
+                info.rrdGraph = rrdGraph
+            self.sensors = sensors
+        for host, sensor in changed:
+            for listener in self.listeners:
+                listener(host, sensor)
+        logging.info("loaded %d sensors" % len(sensors))
+        return self
+
+    def get(self, host, sensor):
+        return self.sensors.get((host, sensor))
+
+    def name(self, host, sensor):
+        info = self.sensors.get((host, sensor))
+        return info.name if info is not None else sensor
+
+    def rrdfile(self, host, sensor):
+        info = self.sensors.get((host, sensor))
+        return info.rrdfile if info is not None else self.rrd_filename(host, sensor)
+
+    def graph_sensors(self):
+        return [(i.host, i.sensor) for i in sorted(self.sensors.values(), key=lambda i: i.id) if i.rrdGraph == 1]
+
+    def register(self, host, sensor):
+        #Returns True when the sensor was not known before
+        with self.lock:
+            if (host, sensor) in self.sensors:
+                return False
+            self.database.register_sensor(host, sensor)
+            #The id is assigned by SQLite, wait for the queued insert to be committed
+            self.database.flush()
+            id = self.database.get_sensor(host, sensor)
+            self.sensors[(host, sensor)] = SensorInfo(id, host, sensor, None, 0, None, self.rrd_filename(host, sensor))
+        return True
+
+    def set_alias(self, host, sensor, alias):
+        info = self.sensors.get((host, sensor))
+        if info is None:
+            return False
+        info.alias = alias
+        self.database.set_sensor_alias(host, sensor, alias)
+        for listener in self.listeners:
+            listener(host, sensor)
+        return True
+
+    def touch(self, host, sensor, timestamp):
+        info = self.sensors.get((host, sensor))
+        if info is None:
+            return
+        info.last_update = timestamp
+        with self.lock:
+            self.dirty.add(info)
+        if time.monotonic() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            dirty = self.dirty
+            self.dirty = set()
+            self.last_flush = time.monotonic()
+        for info in dirty:
+            self.database.update_last_update(info.host, info.sensor, info.last_update)
+        if dirty:
+            logging.debug("wrote last_update of %d sensors" % len(dirty))
+
+class ReadingStore(object):
+    #Raw reading history. Every row is an epoch and a float32 packed in 8 bytes,
+    #appended in blocks to one file per sensor in a directory per UTC day, so a
+    #range query reads only that sensor's rows and retention is a matter of removing
+    #old day directories
+    _row = struct.Struct('<if')
+    _suffix = '.readings'
+
+    def __init__(self, path, block_rows=64, flush_interval=300, retention_days=None):
+        self.path = path
+        self.block_rows = block_rows
+        self.flush_interval = flush_interval
+        self.retention_days = retention_days
+        self._buffer = []
+        self._lock = threading.Lock()
+        self._last_flush = time.time()
+        self._last_day = None
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+    def partition_dir(self, day):
+        return os.path.join(self.path, time.strftime('%Y%m%d', time.gmtime(day * 86400)))
+
+    def partition_file(self, day, sensorId):
+        return os.path.join(self.partition_dir(day), '%d%s' % (sensorId, self._suffix))
+
+    def append(self, sensorId, timestamp, reading):
+        #Packed here, so a row that cannot be stored raises to the caller and never
+        #gets into the buffer
+        row = self._row.pack(timestamp, float(reading))
+        with self._lock:
+            self._buffer.append((sensorId, timestamp, row))
+            if len(self._buffer) >= self.block_rows or time.time() - self._last_flush >= self.flush_interval:
+                self._flush()
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def close(self):
+        self.flush()
+
+    def _flush(self):
+        blocks = {}
+        for sensorId, timestamp, row in self._buffer:
+            key = (timestamp // 86400, sensorId)
+            if key not in blocks:
+                blocks[key] = bytearray()
+            blocks[key] += row
+        self._buffer = []
+        for day, sensorId in blocks:
+            #Unbuffered, so a block is a single O_APPEND write
+            os.makedirs(self.partition_dir(day), exist_ok=True)
+            with open(self.partition_file(day, sensorId), 'ab', buffering=0) as f:
+                f.write(blocks[(day, sensorId)])
+        self._last_flush = time.time()
+
+        today = int(time.time()) // 86400
+        if self.retention_days is not None and self._last_day != today:
+            self._last_day = today
+            self.drop_partitions(self.retention_days)
+
+    def _read_day(self, day, sensorId):
+        #Columns are picked out with strided array slices, which is much faster than
+        #unpacking every row on its own
+        filename = self.partition_file(day, sensorId)
+        if not os.path.exists(filename):
+            return [], []
+        with open(filename, 'rb') as f:
+            data = f.read()
+        data = data[:len(data) - len(data) % self._row.size]
+        times = array.array('i', data)
+        values = array.array('f', data)
+        if sys.byteorder != 'little':
+            times.byteswap()
+            values.byteswap()
+        return times[0::2], values[1::2]
+
+    def query(self, sensorId, start, end):
+        #Readings for a sensor with start <= timestamp < end, as (timestamp, reading)
+        self.flush()
+        result = []
+        for day in range(start // 86400, (end - 1) // 86400 + 1):
+            times, values = self._read_day(day, sensorId)
+            if start <= day * 86400 and (day + 1) * 86400 <= end:
+                #The whole day is in the range
+                result.extend(zip(times, values))
+            else:
+                result.extend((t, v) for t, v in zip(times, values) if start <= t < end)
+        result.sort()
+        return result
+
+    def partitions(self):
+        return sorted(f for f in os.listdir(self.path) if len(f) == 8 and f.isdigit())
+
+    def drop_partitions(self, retention_days):
+        oldest = time.strftime('%Y%m%d', time.gmtime(time.time() - retention_days * 86400))
+        dropped = [f for f in self.partitions() if f < oldest]
+        for f in dropped:
+            logging.info("dropping reading partition %s" % f)
+            try:
+                shutil.rmtree(os.path.join(self.path, f))
+            except FileNotFoundError:
+                #Dropped by another ingest process
+                pass
+        return dropped
+
+
+class ImageStore(object):
+    #Surveillance images sharded as <path>/<host>/<YYYY-MM-DD>/<HHMMSS_ffffff>[_<rendition>].jpeg
+    #in local time. Files are written to a temporary name and renamed, so a reader never
+    #sees a partial image. Every stored frame is appended to the day's manifest.jsonl,
+    #which lists the frames in order without a directory walk or database query. With
+    #dedup, a frame identical to one already stored that day is not written again, its
+    #manifest entry points to the earlier file
+
+    manifest_name = 'manifest.jsonl'
+
+    def __init__(self, path, dedup=False):
+        self.path = path
+        self.dedup = dedup
+        self._lock = threading.Lock()
+        #(host, date) -> {sha1: file}, only the current day of every host
+        self._hashes = {}
+        self.stored = 0
+        self.duplicates = 0
+
+    @staticmethod
+    def safe_host(host):
+        host = re.sub(r'[^A-Za-z0-9_.-]', '_', str(host)).lstrip('.')
+        return host or '_'
+
+    @staticmethod
+    def to_datetime(timestamp):
+        if isinstance(timestamp, datetime.datetime):
+            return timestamp
+        if isinstance(timestamp, str) and not timestamp.isdigit():
+            return datetime.datetime.fromisoformat(timestamp)
+        return datetime.datetime.fromtimestamp(to_epoch(timestamp))
+
+    def day_path(self, host, date):
+        return os.path.join(self.path, self.safe_host(host), date)
+
+    def store(self, host, timestamp, image, rendition='full', writer=None):
+        #Returns the file name relative to path. writer(image, filename) replaces
+        #the plain write, e.g. to store a thumbnail instead of the image
+        dt = self.to_datetime(timestamp)
+        date = dt.date().isoformat()
+        host = self.safe_host(host)
+        name = dt.strftime('%H%M%S_%f')
+        if rendition != 'full':
+            name += '_' + re.sub(r'[^A-Za-z0-9]', '_', rendition)
+        name += '.jpeg'
+        directory = self.day_path(host, date)
+        digest = hashlib.sha1(image).hexdigest() if self.dedup else None
+        with self._lock:
+            if digest is not None:
+                hashes = self.day_hashes(host, date)
+                existing = hashes.get((rendition, digest))
+                if existing is not None:
+                    self.duplicates += 1
+                    self.append_manifest(directory, dt, existing, rendition, digest)
+                    return os.path.join(host, date, existing)
+        os.makedirs(directory, exist_ok=True)
+        tmp = os.path.join(directory, '.%s.%d.tmp.jpeg' % (name, threading.get_ident()))
+        if writer is None:
+            with open(tmp, 'wb') as f:
+                f.write(image)
+        else:
+            writer(image, tmp)
+        os.replace(tmp, os.path.join(directory, name))
+        IMAGE_BYTES_WRITTEN.inc(len(image))
+        with self._lock:
+            if digest is not None:
+                self.day_hashes(host, date)[(rendition, digest)] = name
+            self.append_manifest(directory, dt, name, rendition, digest)
+            self.stored += 1
+        return os.path.join(host, date, name)
+
+    def day_hashes(self, host, date):
+        hashes = self._hashes.get((host, date))
+        if hashes is None:
+            for key in [k for k in self._hashes if k[0] == host]:
+                del self._hashes[key]
+            hashes = self._hashes[(host, date)] = {}
+            for entry in self.manifest(host, date):
+                if entry.get('sha1') is not None:
+                    hashes[(entry['rendition'], entry['sha1'])] = entry['file']
+        return hashes
+
+    def append_manifest(self, directory, dt, name, rendition, digest):
+        line = json.dumps({'timestamp':dt.timestamp(), 'file':name, 'rendition':rendition, 'sha1':digest}) + '\n'
+        fd = os.open(os.path.join(directory, self.manifest_name), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, line.encode('utf-8'))
+        finally:
+            os.close(fd)
+
+    def manifest(self, host, date):
+        entries = []
+        try:
+            with open(os.path.join(self.day_path(host, date), self.manifest_name)) as f:
+                for line in f:
+                    try:
+                        entries.append(json.loads(line))
+                    except ValueError:
+                        #A line cut short by a crash
+                        continue
+        except FileNotFoundError:
+            pass
+        return entries
+
+    def frames(self, host, date, rendition=None):
+        #Paths relative to path, in time order
+        entries = self.manifest(host, date)
+        if rendition is not None:
+            entries = [e for e in entries if e['rendition'] == rendition]
+        entries.sort(key=lambda e: e['timestamp'])
+        prefix = os.path.join(self.safe_host(host), date)
+        return [os.path.join(prefix, e['file']) for e in entries]
+
+    def hosts(self):
+        return sorted(h for h in os.listdir(self.path) if os.path.isdir(os.path.join(self.path, h)))
+
+    def dates(self, host, before=None):
+        dates = []
+        for d in os.listdir(os.path.join(self.path, self.safe_host(host))):
+            if re.match(r'^\d{4}-\d{2}-\d{2}$', d) and (before is None or d < before):
+                dates.append(d)
+        return sorted(dates)
+
+    def delete_day(self, host, date):
+        shutil.rmtree(self.day_path(host, date), ignore_errors=True)
+        try:
+            os.rmdir(os.path.join(self.path, self.safe_host(host)))
+        except OSError:
+            #Other days left
+            pass
+        with self._lock:
+            self._hashes.pop((self.safe_host(host), date), None)
+
+    def get_stats(self):
+        return {'stored':self.stored, 'duplicates':self.duplicates}
+
 class ThermometerProtocol(object):
 
     def new_reading(self, sensor, reading, timestamp=datetime.datetime.now()):
@@ -188,50 +866,469 @@ class ThermometerProtocol(object):
         data = {'notification':notification}
         return json.dumps(data)
 
+    #Messages on the temperature topics, by their single top level key
+    schemas = {
+        'reading': compile_schema((('host', str), ('sensor', str), ('reading', (float, int, str)), ('timestamp', (str, int, float)))),
+        'readings': compile_schema((('host', str), ('fields', list), ('rows', list))),
+        'register_sensor': compile_schema((('host', str), ('sensor', str))),
+        'sensor_alias': compile_schema((('host', str), ('sensor', str), ('alias', (str, type(None))))),
+    }
+
     def parse_message(self, message):
-        dataDict = json.loads(message)
+        #message can be bytes, orjson and json both decode UTF-8 themselves
+        dataDict = json_loads(message)
         return dataDict
 
+    def parse_typed_message(self, message):
+        #Returns the message type and its validated body
+        dataDict = self.parse_message(message)
+        if isinstance(dataDict, dict):
+            for kind in dataDict:
+                validate = self.schemas.get(kind)
+                if validate is not None:
+                    return kind, validate(dataDict[kind])
+        raise ValueError("unknown message %r" % (message[:100],))
+
+    def parse_binary_image(self, payload):
+        #Returns the header and a memoryview of the JPEG data, so the image is never copied
+        view = memoryview(payload)
+        if view[:len(IMAGE_HEADER_MAGIC)] != IMAGE_HEADER_MAGIC:
+            raise ValueError("binary image message without header magic")
+        offset = len(IMAGE_HEADER_MAGIC)
+        (length,) = struct.unpack_from('!H', view, offset)
+        offset += 2
+        header = json.loads(bytes(view[offset:offset+length]).decode('utf-8'))
+        return header, view[offset+length:]
+
+    def parse_reading_batch(self, batch):
+        #Expands a JSON batch into reading dicts as sent by new_reading
+        host = batch['host']
+        fields = batch['fields']
+        readings = []
+        for row in batch['rows']:
+            reading = dict(zip(fields, row))
+            reading['host'] = host
+            readings.append(reading)
+        return readings
+
+    def parse_binary_reading_batch(self, payload):
+        view = memoryview(payload)
+        if view[:len(READING_BATCH_MAGIC)] != READING_BATCH_MAGIC:
+            raise ValueError("binary reading batch without header magic")
+        offset = len(READING_BATCH_MAGIC)
+        (length,) = struct.unpack_from('!H', view, offset)
+        offset += 2
+        header = json.loads(bytes(view[offset:offset+length]).decode('utf-8'))
+        offset += length
+        host = header['host']
+        sensors = header['sensors']
+        fields = header['fields']
+        row = struct.Struct('!BI' + 'f' * len(fields))
+        readings = []
+        for values in row.iter_unpack(view[offset:]):
+            reading = dict(zip(fields, values[2:]))
+            reading['host'] = host
+            reading['sensor'] = sensors[values[0]]
+            reading['timestamp'] = values[1]
+            readings.append(reading)
+        return readings
+
+
+class RRDUpdater(object):
+    #Buffers updates per RRD file and writes several timestamp:value pairs with one
+    #rrdtool.update call. With an rrdcached address the updates go to the daemon instead
+
+    def __init__(self, batch_size=5, flush_interval=300, daemon=None):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.daemon = daemon
+        self._pending = {}
+        self._oldest = {}
+        self._last = {}
+        self._file_locks = {}
+        self._lock = threading.Lock()
+
+    def last_update(self, rrdfile):
+        #Last timestamp in the file, so updates that rrdtool would refuse after a
+        #restart, a redelivery or for a file created with --start now are dropped here
+        try:
+            args = [rrdfile]
+            if self.daemon is not None:
+                args = ["--daemon", self.daemon] + args
+            return rrdtool.last(*args)
+        except Exception as e:
+            logging.debug("no last update for %s: %s", rrdfile, e)
+            return None
+
+    def update(self, rrdfile, timestamp, value):
+        if rrdfile not in self._last:
+            last = self.last_update(rrdfile)
+            if last is not None:
+                with self._lock:
+                    self._last.setdefault(rrdfile, last)
+        with self._lock:
+            #RRD refuses updates that are not newer than the last one
+            if timestamp <= self._last.get(rrdfile, 0):
+                logging.debug("dropping out of order RRD update %s %d", rrdfile, timestamp)
+                return
+            self._last[rrdfile] = timestamp
+            pending = self._pending.setdefault(rrdfile, [])
+            if not pending:
+                self._oldest[rrdfile] = time.time()
+            pending.append("%d:%f" % (timestamp,value))
+            RRD_UPDATES.inc()
+            due = len(pending) >= self.batch_size or time.time() - self._oldest[rrdfile] >= self.flush_interval
+        if due:
+            self._flush_file(rrdfile)
+
+    def flush(self):
+        with self._lock:
+            files = list(self._pending)
+        for rrdfile in files:
+            self._flush_file(rrdfile)
+        if self.daemon is not None and files:
+            try:
+                rrdtool.flushcached("--daemon", self.daemon, *files)
+            except Exception as e:
+                logging.exception(e)
+
+    def _flush_file(self, rrdfile):
+        #The file lock keeps batches for one file in order when a flush races a worker
+        with self._lock:
+            lock = self._file_locks.setdefault(rrdfile, threading.Lock())
+        with lock:
+            with self._lock:
+                updates = self._pending.pop(rrdfile, [])
+            if not updates:
+                return
+            args = [rrdfile, "--template", "a"]
+            if self.daemon is not None:
+                args += ["--daemon", self.daemon]
+            logging.debug("RRD update : %s, %s", rrdfile, updates)
+            try:
+                with RRD_UPDATE_SECONDS.time():
+                    rrdtool.update(*(args + updates))
+                RRD_WRITES.inc()
+            except Exception as e:
+                #rrdtool stops at the first update it rejects, retry them one by one
+                #so one bad update does not take the rest of the batch with it
+                logging.warning("RRD update of %s failed: %s" % (rrdfile,e))
+                for u in updates:
+                    try:
+                        rrdtool.update(*(args + [u]))
+                        RRD_WRITES.inc()
+                    except Exception as e:
+                        RRD_UPDATE_ERRORS.inc()
+                        logging.error("dropping RRD update %s %s: %s" % (rrdfile,u,e))
+
+    def pending(self):
+        with self._lock:
+            return sum(len(p) for p in self._pending.values())
+
+
+class MencoderEncoder(object):
+    name = 'mencoder'
+
+    def __init__(self, fps=24, bitrate=8000000, scale='2592:1944', priority=None):
+        self.fps = fps
+        self.bitrate = bitrate
+        self.scale = scale
+        self.priority = priority or []
+
+    def run(self, cmd, cwd=None, stdin=None):
+        p = subprocess.Popen(self.priority + cmd, cwd=cwd, stdin=stdin)
+        return p
+
+    def wait(self, p, cmd):
+        if p.wait() != 0:
+            raise RuntimeError("%s exited with %d" % (' '.join(cmd), p.returncode))
+
+    def encode(self, images, output, cwd):
+        listfile = output + '.txt'
+        with open(listfile, 'wt') as f:
+            for img in images:
+                f.write(img + "\n")
+        cmd = shlex.split("/usr/bin/mencoder -nosound -ovc lavc -lavcopts vcodec=mpeg4:aspect=16/9:vbitrate=%d" % self.bitrate)
+        if self.scale:
+            cmd += ['-vf', 'scale=%s' % self.scale]
+        cmd += ['-o', output, '-mf', 'type=jpeg:fps=%d' % self.fps, 'mf://@%s' % listfile]
+        try:
+            self.wait(self.run(cmd, cwd), cmd)
+        finally:
+            os.unlink(listfile)
+
+    def concat(self, segments, output):
+        cmd = ['/usr/bin/mencoder', '-nosound', '-ovc', 'copy', '-o', output] + segments
+        self.wait(self.run(cmd), cmd)
+
+
+class FfmpegEncoder(MencoderEncoder):
+    #Streams the frames to ffmpeg through image2pipe instead of handing it a file list
+    name = 'ffmpeg'
+
+    def encode(self, images, output, cwd):
+        cmd = ['ffmpeg', '-y', '-loglevel', 'error', '-f', 'image2pipe', '-framerate', str(self.fps), '-c:v', 'mjpeg', '-i', '-',
+               '-c:v', 'mpeg4', '-b:v', str(self.bitrate), '-an']
+        if self.scale:
+            cmd += ['-vf', 'scale=%s' % self.scale]
+        cmd += [output]
+        p = self.run(cmd, cwd, subprocess.PIPE)
+        try:
+            for img in images:
+                with open(os.path.join(cwd, img), 'rb') as f:
+                    shutil.copyfileobj(f, p.stdin)
+        finally:
+            p.stdin.close()
+        self.wait(p, cmd)
+
+    def concat(self, segments, output):
+        listfile = output + '.txt'
+        with open(listfile, 'wt') as f:
+            for s in segments:
+                f.write("file '%s'\n" % s.replace("'", "'\\''"))
+        cmd = ['ffmpeg', '-y', '-loglevel', 'error', '-f', 'concat', '-safe', '0', '-i', listfile, '-c', 'copy', output]
+        try:
+            self.wait(self.run(cmd), cmd)
+        finally:
+            os.unlink(listfile)
+
+
+TIMELAPSE_ENCODERS = {'mencoder':MencoderEncoder, 'ffmpeg':FfmpegEncoder}
+
+def low_priority_command(niceness=10):
+    #Command prefix running the encoders at idle I/O and lowered CPU priority
+    cmd = []
+    if niceness is None:
+        return cmd
+    if shutil.which('ionice') is not None:
+        cmd += ['ionice', '-c', '3']
+    cmd += ['nice', '-n', str(niceness)]
+    return cmd
+
+
+class IncrementalTimelapse(object):
+    #Feeds every received image straight into a running per host, per day ffmpeg
+    #process writing an MPEG-TS segment. Finishing a day only joins the segments, a
+    #server restart simply starts a new segment
+    _segment_re = re.compile(r'^(.*)_(\d{4}-\d{2}-\d{2})\.seg(\d+)\.ts$')
+
+    def __init__(self, timelapsePath, fps=24, bitrate=8000000, scale=None, thumbnail_scale='640:-1', priority=None, owns=None):
+        self.timelapsePath = timelapsePath
+        #With several ingest processes, only the segments of hosts owns() is true for
+        #are finalized, the others may still be written by another process
+        self.owns = owns
+        self.fps = fps
+        self.bitrate = bitrate
+        self.scale = scale
+        self.thumbnail_scale = thumbnail_scale
+        self.priority = priority or []
+        self.sessions = {}
+        self._lock = threading.Lock()
+
+    def segments(self):
+        #(host, date, segment file) for every segment on disk
+        result = []
+        for f in sorted(os.listdir(self.timelapsePath)):
+            m = self._segment_re.match(f)
+            if m is not None:
+                result.append((m.group(1), m.group(2), os.path.join(self.timelapsePath, f)))
+        return result
+
+    def _open(self, host, date):
+        #Numbered after the last segment on disk, earlier ones may have been joined
+        #and removed while a later one is still written
+        n = 0
+        for h, d, segment in self.segments():
+            if h == host and d == date:
+                n = int(self._segment_re.match(os.path.basename(segment)).group(3)) + 1
+        segment = os.path.join(self.timelapsePath, "%s_%s.seg%04d.ts" % (host,date,n))
+        cmd = ['ffmpeg', '-y', '-loglevel', 'error', '-f', 'image2pipe', '-framerate', str(self.fps), '-c:v', 'mjpeg', '-i', '-',
+               '-c:v', 'mpeg4', '-b:v', str(self.bitrate), '-an']
+        if self.scale:
+            cmd += ['-vf', 'scale=%s' % self.scale]
+        cmd += ['-f', 'mpegts', segment]
+        logging.info("starting timelapse segment %s" % segment)
+        return subprocess.Popen(self.priority + cmd, stdin=subprocess.PIPE)
+
+    def _close(self, host, date):
+        p = self.sessions.pop((host, date))
+        try:
+            p.stdin.close()
+        except Exception as e:
+            logging.exception(e)
+        if p.wait() != 0:
+            logging.error("timelapse encoder for %s %s exited with %d" % (host,date,p.returncode))
+
+    def add_frame(self, host, date, image):
+        #Sessions are per host and day, so a late frame of an earlier day gets a
+        #segment of its own instead of closing the running one. Sessions of past
+        #days are closed by finalize_before
+        key = (host, date)
+        with self._lock:
+            if key not in self.sessions:
+                self.sessions[key] = self._open(host, date)
+            try:
+                self.sessions[key].stdin.write(image)
+                self.sessions[key].stdin.flush()
+            except (IOError, ValueError) as e:
+                #The encoder died, the next frame starts a new segment
+                logging.exception(e)
+                self._close(host, date)
+
+    def write_thumbnail(self, image, filename):
+        cmd = ['ffmpeg', '-y', '-loglevel', 'error', '-f', 'image2pipe', '-c:v', 'mjpeg', '-i', '-', '-vf', 'scale=%s' % self.thumbnail_scale, filename]
+        subprocess.run(self.priority + cmd, input=image, check=True)
+
+    def finalize_before(self, date):
+        #Joins the segments of every day before date into <host>_<date>.avi. Segments
+        #of a day that was finalized already, from frames that arrived late, are
+        #appended to its timelapse
+        with self._lock:
+            for host, day in [k for k in self.sessions if k[1] < date]:
+                self._close(host, day)
+            days = {}
+            for host, day, segment in self.segments():
+                if self.owns is not None and not self.owns(host):
+                    continue
+                if day < date and (host, day) not in self.sessions:
+                    days.setdefault((host, day), []).append(segment)
+        for (host, day), segments in sorted(days.items()):
+            output = os.path.join(self.timelapsePath, "%s_%s.avi" % (host,day))
+            inputs = list(segments)
+            if os.path.exists(output):
+                inputs.insert(0, output)
+            listfile = output + '.txt'
+            joined = output + '.tmp'
+            with open(listfile, 'wt') as f:
+                for s in inputs:
+                    f.write("file '%s'\n" % s.replace("'", "'\\''"))
+            cmd = ['ffmpeg', '-y', '-loglevel', 'error', '-f', 'concat', '-safe', '0', '-i', listfile, '-c', 'copy', '-f', 'avi', joined]
+            try:
+                subprocess.run(self.priority + cmd, check=True)
+                os.replace(joined, output)
+                for s in segments:
+                    os.unlink(s)
+                logging.info("finalized timelapse %s" % output)
+            except Exception as e:
+                logging.exception(e)
+                if os.path.exists(joined):
+                    os.unlink(joined)
+            finally:
+                os.unlink(listfile)
+
+    def close(self):
+        with self._lock:
+            for host, date in list(self.sessions):
+                self._close(host, date)
+
 
 class TimelapseCreator(Thread):
 
-    def __init__(self, imagePath, timelapsePath, databasePath):
+    def __init__(self, imagePath, timelapsePath, databasePath, encoder=None, workers=None, segment_frames=500, incremental=None, rendition='full', imageStore=None):
         super(TimelapseCreator, self).__init__()
+        self.imageStore = imageStore if imageStore is not None else ImageStore(imagePath)
+        self.rendition = rendition
         self.daemon = True
         self.imagePath = imagePath
         self.timelapsePath = timelapsePath
         self.databasePath = databasePath
+        self.incremental = incremental
+        self.encoder = encoder if encoder is not None else MencoderEncoder()
+        self.workers = workers or os.cpu_count() or 1
+        self.segment_frames = segment_frames
+        self.job_stats = collections.deque(maxlen=100)
+
+    def encode_job(self, h, d, images):
+        #Encodes the frames in segments of segment_frames, and records finished segments
+        #in a checkpoint file, so a job killed halfway resumes at the next segment
+        start = time.time()
+        output = os.path.join(self.timelapsePath, "%s_%s.avi" % (h,d))
+        checkpoint = output + '.checkpoint'
+        done = 0
+        if os.path.exists(checkpoint):
+            with open(checkpoint) as f:
+                done = json.load(f)['segments']
+        resumed = done
+        segments = []
+        for i in range(0, len(images), self.segment_frames):
+            segment = "%s.part%04d.avi" % (output, len(segments))
+            if len(segments) >= done or not os.path.exists(segment):
+                self.encoder.encode(images[i:i+self.segment_frames], segment, self.imagePath)
+                with open(checkpoint, 'wt') as f:
+                    json.dump({'segments':len(segments)+1}, f)
+            segments.append(segment)
+
+        #A timelapse already there for the day, e.g. when frames arrived after it was
+        #made, goes first. Not when resuming, the job may have been killed after
+        #writing it
+        inputs = segments
+        if resumed == 0 and os.path.exists(output):
+            inputs = [output] + segments
+        if len(inputs) == 1:
+            os.rename(segments[0], output)
+        else:
+            joined = output + '.tmp.avi'
+            self.encoder.concat(inputs, joined)
+            os.replace(joined, output)
+            for s in segments:
+                os.unlink(s)
+        os.unlink(checkpoint)
+        stats = {'host':h, 'date':d, 'frames':len(images), 'segments':len(segments),
+                 'resumed_segments':resumed, 'seconds':time.time() - start}
+        self.job_stats.append(stats)
+        TIMELAPSE_ENCODE_SECONDS.observe(stats['seconds'])
+        logging.info("timelapse %s_%s: %d frames in %.1fs" % (h,d,len(images),stats['seconds']))
+        return stats
 
     def create_timelapse(self):
+        #Days come from the image store manifests. Images stored before the image
+        #store, flat in imagePath, are still listed in the Surveillance table
+        days = {}
         for host in self.database.get_surveillance_hosts_iter():
-            h = host[0]
-            for date in self.database.get_surveillance_dates_iter(h):
-                d = date[0]
-                logging.debug(d)
-                logging.debug(h)
-                #pdb.set_trace()
-                images = self.database.get_surveillance_files_for_date(d,h)
-                mfile = os.path.join(self.imagePath,"%s_%s_surveillance_files.txt" % (h,d))
-                with open(mfile,"wt") as f:
-                    for img in images:
-                        f.write(str(img[0])+"\n")
+            for date in self.database.get_surveillance_dates_iter(host[0]):
+                days[(ImageStore.safe_host(host[0]), date[0])] = host[0]
+        today = datetime.date.today().isoformat()
+        for h in self.imageStore.hosts():
+            for d in self.imageStore.dates(h, today):
+                days.setdefault((h, d), None)
+
+        jobs = {}
+        with concurrent.futures.ThreadPoolExecutor(self.workers) as pool:
+            for (h, d), legacyHost in sorted(days.items()):
+                logging.debug("timelapse for %s %s" % (h,d))
+                images = []
+                frames = []
+                if legacyHost is not None:
+                    images = [str(img[0]) for img in self.database.get_surveillance_files_for_date(d,legacyHost)]
+                    frames = [str(img[0]) for img in self.database.get_surveillance_files_for_date(d,legacyHost,self.rendition)] or images
+                stored = self.imageStore.frames(h,d)
+                frames = frames + (self.imageStore.frames(h,d,self.rendition) or stored)
+                existing = [i for i in frames if os.path.exists(os.path.join(self.imagePath,i))]
+                if not existing:
+                    self.cleanup_day(h,d,legacyHost,images)
+                    continue
+                jobs[pool.submit(self.encode_job,h,d,existing)] = (h,d,legacyHost,images)
+
+            for job in concurrent.futures.as_completed(jobs):
+                h,d,legacyHost,images = jobs[job]
                 try:
-                    out = shlex.split("/usr/bin/mencoder -nosound -ovc lavc -lavcopts vcodec=mpeg4:aspect=16/9:vbitrate=8000000 -vf scale=2592:1944 -o '%s/%s_%s.avi' -mf type=jpeg:fps=24 mf://@%s_%s_surveillance_files.txt" % (self.timelapsePath,h,d,h,d))
-                    p = subprocess.Popen(out,cwd=self.imagePath)
-                    (stdoutdata,stdindata) = p.communicate()
-                    logging.debug(stdoutdata)
-                    os.unlink(os.path.join(self.imagePath,"%s_%s_surveillance_files.txt") % (h,d))
-                    for img in images:
-                        try:
-                            i = img[0]
-                            ipath = os.path.join(self.imagePath,i)
-                            if(os.path.exists(ipath)):
-                                os.unlink(ipath)
-                        except Exception as e:
-                            logging.exception(e)
-                    self.database.delete_surveillance_files(h,d)
+                    job.result()
                 except Exception as e:
                     logging.exception(e)
+                    continue
+                self.cleanup_day(h,d,legacyHost,images)
+
+    def cleanup_day(self, h, d, legacyHost, images):
+        for i in images:
+            try:
+                ipath = os.path.join(self.imagePath,i)
+                if(os.path.exists(ipath)):
+                    os.unlink(ipath)
+            except Exception as e:
+                logging.exception(e)
+        if legacyHost is not None:
+            self.database.delete_surveillance_files(legacyHost,d)
+        self.imageStore.delete_day(h,d)
 
     def clean_timelapse(self,max_age=604800):
         oldest = (time.time() // 86400) - max_age
@@ -247,16 +1344,42 @@ class TimelapseCreator(Thread):
         self.database = SurveillanceDatabase().open(self.databasePath)
         while True:
             try:
-                self.create_timelapse()
+                if self.incremental is not None:
+                    self.incremental.finalize_before(datetime.date.today().isoformat())
+                else:
+                    self.create_timelapse()
                 self.clean_timelapse()
                 time.sleep(3600)
             except Exception as e:
                 logging.exception(e)
 
 
+def render_graph(filename, args):
+    #Runs in a RRDGraphCreator worker process
+    start = time.time()
+    rrdtool.graph(filename, *args)
+    return time.time() - start
+
+
 class RRDGraphCreator(Thread):
 
-    def __init__(self, rrdPath, rrdImagePath, databasePath, mqttClient=None):
+    #Name, extra rrdtool.graph arguments and default render interval in seconds
+    graphs = [
+        ('hour', ["--start","-6h"], 60),
+        ('day', ["--start","-1d","--end","now","-v","Last 24 hours"], 300),
+        ('week', ["--start","-1w","--end","now","-v","Last week"], 1800),
+        ('month', ["--start","-1m","--end","now","-v","Last month"], 3600),
+        ('year', ["--start","-1y","--end","now","-v","Last year"], 21600),
+    ]
+    graph_options = ["-u","35",
+                     "-l","-10",
+                     "--full-size-mode",
+                     "--width","700",
+                     "--height","400",
+                     "--slope-mode",
+                     "--color","SHADEB#9999CC"]
+
+    def __init__(self, rrdPath, rrdImagePath, databasePath, mqttClient=None, rrdUpdater=None, schedule=None, workers=None, registry=None, solar=None):
         super(RRDGraphCreator, self).__init__()
         self.daemon = True
         self.rrdPath = rrdPath
@@ -264,40 +1387,59 @@ class RRDGraphCreator(Thread):
         self.databasePath = databasePath
         self.protocol = ThermometerProtocol()
         self.mqttClient = mqttClient
+        self.rrdUpdater = rrdUpdater
+        self.registry = registry
+        self.solar = solar if solar is not None else SolarSchedule()
+        self.schedule = dict((name, interval) for name, args, interval in self.graphs)
+        if schedule is not None:
+            self.schedule.update(schedule)
+        self.workers = len(self.graphs) if workers is None else workers
+        self.pool = None
+        #Per graph: last render time, max mtime of the source RRD files at that
+        #render and render duration
+        self.render_stats = dict((name, {'last_render':0, 'source_mtime':None, 'seconds':0.0}) for name, args, interval in self.graphs)
+        self.renders = dict((name, REGISTRY.counter('graph_renders', "Scheduled graph renders", {'graph':name})) for name, args, interval in self.graphs)
+        self.skipped = dict((name, REGISTRY.counter('graph_renders_skipped', "Scheduled graph renders skipped because no RRD file changed", {'graph':name})) for name, args, interval in self.graphs)
+        for name, args, interval in self.graphs:
+            REGISTRY.gauge('graph_last_render_timestamp', "When a graph was last rendered", {'graph':name}, lambda name=name: self.render_stats[name]['last_render'])
 
     def run(self):
         self.database = SurveillanceDatabase()
         self.database.open(self.databasePath)
+        if self.workers > 0:
+            #spawn, forking a process with running threads is not safe
+            self.pool = concurrent.futures.ProcessPoolExecutor(self.workers, multiprocessing.get_context('spawn'))
+        last_check = 0
         while True:
-            logging.info("Checking last_update")
-            rows = self.database.check_last_update()
-            for r in rows:
-                n = self.protocol.new_notification("Sensor %s on host %s, last update %s" % (r[0],r[1],r[2]))
-                self.database.update_notification_sent(r[0],r[1])
-                self.mqttClient.publish('/surveillance/notification/%s/temperature/alert' % (r[0],),n,2)
+            if self.registry is not None and time.time() - last_check >= 600:
+                last_check = time.time()
+                self.registry.load()
 
-            logging.info("Updating RRD Graphs")
-            self.create_rrd_graph()
-            logging.debug("Done updating RRD Graphs")
-            time.sleep(600)
+            try:
+                self.create_rrd_graph()
+            except Exception as e:
+                logging.exception(e)
+            time.sleep(min(self.schedule.values()))
 
     def sundata(self):
-        a = astral.Astral()
-        a.solar_depression = 'civil'
-        sun = a['Copenhagen'].sun(datetime.datetime.now(),local=True)
-        dusk = sun['dusk']
-        dawn = sun['dawn']
-        sunrise = sun['sunrise']
-        sunset = sun['sunset']
-        #pdb.set_trace()
-        dusks = int(abs((dusk - dusk.replace(hour=0, minute=0, second=0, microsecond=0)).total_seconds()))
-        dawns = int(abs((dawn - dawn.replace(hour=0, minute=0, second=0, microsecond=0)).total_seconds()))
-        sunss = int(abs((sunset - sunset.replace(hour=0, minute=0, second=0, microsecond=0)).total_seconds()))
-        sunrs = int(abs((sunrise - sunrise.replace(hour=0, minute=0, second=0, microsecond=0)).total_seconds()))
-        return sunrs,sunss,dusks,dawns
-
-    def create_rrd_graph(self):
+        day = self.solar.day()
+        return day.sunrise,day.sunset,day.dusk,day.dawn
+
+    def get_graph_sensors(self):
+        if self.registry is not None:
+            return self.registry.graph_sensors()
+        return list(self.database.get_graph_sensors_iter())
+
+    def is_known_sensor(self, host, sensor):
+        if self.registry is not None:
+            return self.registry.get(host, sensor) is not None
+        return self.database.get_sensor(host, sensor) is not None
+
+    def get_graph_defs(self, sensors=None):
+        #Returns the DEF/CDEF/LINE arguments for the graph sensors, or the given
+        #(host, sensor) pairs, and the RRD files they read from
         defs = []
+        rrdfiles = []
         logging.debug("getting sensors from database")
         colors = ['#FF0000','#00DC00','#00FF00','#0000FF','#8F4F00']
         cur_color = 0
@@ -305,10 +1447,16 @@ class RRDGraphCreator(Thread):
         suninf = False
         defs.append('COMMENT:Location\\t    Last\\t\\tAvg\\t\\tMax\\t\\tMin\\n')
         defs.append('HRULE:0#0000FF:freezing\\n')
-        for host,sensor in self.database.get_graph_sensors_iter():
-            logging.debug("Get sensor name : %s,%s" % (host,sensor))
-            sensor_name = self.database.get_sensor_name(host,sensor)
-            rrdfile = os.path.join(self.rrdPath,"%s_%s_temperature.rrd" % (host,sensor))
+        if sensors is None:
+            sensors = self.get_graph_sensors()
+        for host,sensor in sensors:
+            if self.registry is not None:
+                sensor_name = self.registry.name(host,sensor)
+                rrdfile = self.registry.rrdfile(host,sensor)
+            else:
+                sensor_name = self.database.get_sensor_name(host,sensor)
+                rrdfile = os.path.join(self.rrdPath,"%s_%s_temperature.rrd" % (host,sensor))
+            rrdfiles.append(rrdfile)
             #defs.append('COMMENT:\\u')
             defs.append("DEF:%s=%s:a:AVERAGE" % (sensor,rrdfile))
             defs.append("LINE2:%s%s:%s\\t" % (sensor,colors[cur_color],sensor_name))
@@ -328,166 +1476,782 @@ class RRDGraphCreator(Thread):
                 suninf = True
 
             cur_color = cur_color + 1 if cur_color +1 < len(colors) else 0
-        try:
-            logging.info("Generating RRD Graphs")
-            rrdtool.graph(os.path.join(self.rrdImagePath,"temperature-hour.png" ),
-                        "--start","-6h",
-                        "-u","35",
-                        "-l","-10",
-                        "--full-size-mode",
-                        "--width","700",
-                        "--height","400",
-                        "--slope-mode",
-                        "--color","SHADEB#9999CC",
-                        defs
-                          )
-
-            rrdtool.graph(os.path.join(self.rrdImagePath,"temperature-day.png" ),
-                        "--start","-1d",
-                        "--end","now",
-                        "-u","35",
-                        "-l","-10",
-                        "-v","Last 24 hours",
-                        "--full-size-mode",
-                        "--width","700",
-                        "--height","400",
-                        "--slope-mode",
-                        "--color","SHADEB#9999CC",
-                        defs
-                          )
-
-            rrdtool.graph(os.path.join(self.rrdImagePath,"temperature-week.png" ),
-                        "--start","-1w",
-                        "--end","now",
-                        "-u","35",
-                        "-l","-10",
-                        "-v","Last week",
-                        "--full-size-mode",
-                        "--width","700",
-                        "--height","400",
-                        "--slope-mode",
-                        "--color","SHADEB#9999CC",
-                         defs
-                          )
-
-            rrdtool.graph(os.path.join(self.rrdImagePath,"temperature-month.png" ),
-                        "--start","-1m",
-                        "--end","now",
-                        "-u","35",
-                        "-l","-10",
-                        "-v","Last month",
-                        "--full-size-mode",
-                        "--width","700",
-                        "--height","400",
-                        "--slope-mode",
-                        "--color","SHADEB#9999CC",
-                         defs
-                          )
-
-            rrdtool.graph(os.path.join(self.rrdImagePath,"temperature-year.png" ),
-                        "--start","-1y",
-                        "--end","now",
-                        "-u","35",
-                        "-l","-10",
-                        "-v","Last year",
-                        "--full-size-mode",
-                        "--width","700",
-                        "--height","400",
-                        "--slope-mode",
-                        "--color","SHADEB#9999CC",
-                        defs
-                          )
+        return defs, rrdfiles
+
+    def create_rrd_graph(self, force=False):
+        #Renders the graphs whose interval has passed and whose source RRD files
+        #changed since they were last rendered
+        now = time.time()
+        due = [g for g in self.graphs if force or now - self.render_stats[g[0]]['last_render'] >= self.schedule[g[0]]]
+        if not due:
+            return
+        if self.rrdUpdater is not None:
+            self.rrdUpdater.flush()
+        defs, rrdfiles = self.get_graph_defs()
+        source_mtime = max([os.path.getmtime(f) for f in rrdfiles if os.path.exists(f)] or [0])
+
+        jobs = {}
+        for name, args, interval in due:
+            stats = self.render_stats[name]
+            filename = os.path.join(self.rrdImagePath,"temperature-%s.png" % name)
+            if not force and stats['source_mtime'] == source_mtime and os.path.exists(filename):
+                logging.debug("%s graph is up to date" % name)
+                self.skipped[name].inc()
+                continue
+            graph_args = args + self.graph_options + defs
+            if self.pool is not None:
+                jobs[name] = self.pool.submit(render_graph, filename, graph_args)
+            else:
+                jobs[name] = None
+                try:
+                    stats['seconds'] = render_graph(filename, graph_args)
+                except Exception as e:
+                    logging.exception(e)
+                    continue
+            stats['last_render'] = now
+            stats['source_mtime'] = source_mtime
+
+        logging.info("Generating RRD Graphs %s" % ','.join(jobs))
+        for name in jobs:
+            stats = self.render_stats[name]
+            if jobs[name] is not None:
+                try:
+                    stats['seconds'] = jobs[name].result()
+                except Exception as e:
+                    logging.exception(e)
+                    stats['source_mtime'] = None
+                    continue
+            self.renders[name].inc()
+            GRAPH_RENDER_SECONDS.observe(stats['seconds'])
+            logging.info("rendered %s graph in %.2fs" % (name,stats['seconds']))
 
+
+class GraphRequestHandler(http.server.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        url = urllib.parse.urlparse(self.path)
+        if url.path != '/graph.png':
+            self.send_error(404)
+            return
+        try:
+            params = self.server.graphServer.parse_params(urllib.parse.parse_qs(url.query))
+        except ValueError as e:
+            self.send_error(400, str(e))
+            return
+        try:
+            etag, image = self.server.graphServer.render(params, self.headers.get('If-None-Match'))
         except Exception as e:
             logging.exception(e)
+            self.send_error(500)
+            return
+        if image is None:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/png')
+        self.send_header('Content-Length', str(len(image)))
+        self.send_header('ETag', etag)
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        self.wfile.write(image)
+
+    def log_message(self, format, *args):
+        logging.debug("http %s - %s" % (self.address_string(), format % args))
+
+
+class GraphServer(Thread):
+    #Renders graphs on request, e.g. /graph.png?start=-2d&end=now&sensors=host:sensor&width=800&height=300
+    #Images are kept in an LRU cache keyed by the parameters and the last update time
+    #of the RRD files they are drawn from, which also serves as the ETag
+    _time_re = re.compile(r'^[-+a-zA-Z0-9: ]+$')
+
+    def __init__(self, graphCreator, bind='127.0.0.1', port=8080, cache_size=32, flush_interval=60):
+        super(GraphServer, self).__init__()
+        self.daemon = True
+        self.graphCreator = graphCreator
+        self.bind = bind
+        self.port = port
+        self.cache_size = cache_size
+        self.flush_interval = flush_interval
+        self.last_flush = None
+        self._cache = collections.OrderedDict()
+        self._lock = threading.Lock()
+        REGISTRY.gauge('graph_cache_entries', "Rendered graphs in the graph cache", function=lambda: len(self._cache))
+
+    def run(self):
+        httpd = http.server.ThreadingHTTPServer((self.bind, self.port), GraphRequestHandler)
+        httpd.graphServer = self
+        logging.info("serving graphs on %s:%d" % (self.bind,self.port))
+        httpd.serve_forever()
+
+    def parse_params(self, query):
+        def get(name, default):
+            return query.get(name, [default])[0]
+        start = get('start', '-1d')
+        end = get('end', 'now')
+        for t in (start, end):
+            if not self._time_re.match(t):
+                raise ValueError("invalid time %s" % t)
+        width = min(max(int(get('width', '700')), 100), 4000)
+        height = min(max(int(get('height', '400')), 100), 4000)
+        sensors = None
+        if 'sensors' in query:
+            sensors = []
+            for s in ','.join(query['sensors']).split(','):
+                host, _, sensor = s.partition(':')
+                #Only known sensors, the names end up in rrdtool arguments
+                if not self.graphCreator.is_known_sensor(host, sensor):
+                    raise ValueError("unknown sensor %s" % s)
+                sensors.append((host, sensor))
+        else:
+            sensors = self.graphCreator.get_graph_sensors()
+        return (start, end, width, height, tuple(sensors))
+
+    def render(self, params, if_none_match=None):
+        #Returns the ETag and the image, or None as the image if it matches if_none_match
+        start, end, width, height, sensors = params
+        updater = self.graphCreator.rrdUpdater
+        if updater is not None:
+            #Buffered RRD updates are written at most every flush_interval seconds,
+            #otherwise a polling dashboard would write every buffered file on each
+            #poll. The ETag follows what has been written
+            now = time.monotonic()
+            with self._lock:
+                due = self.last_flush is None or now - self.last_flush >= self.flush_interval
+                if due:
+                    self.last_flush = now
+            if due:
+                updater.flush()
+        #The files the graph is drawn from, as resolved by the sensor registry, so
+        #the ETag follows the same files as the rendered graph
+        graphCreator = self.graphCreator
+        defs, rrdfiles = graphCreator.get_graph_defs(sensors)
+        last = tuple(rrdtool.last(f) if os.path.exists(f) else 0 for f in rrdfiles)
+        key = (params, tuple(rrdfiles), last)
+        etag = '"%s"' % hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+        if if_none_match is not None and etag in [e.strip() for e in if_none_match.split(',')]:
+            GRAPH_NOT_MODIFIED.inc()
+            return etag, None
+
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                GRAPH_CACHE_HITS.inc()
+                return etag, self._cache[key]
+        GRAPH_CACHE_MISSES.inc()
+
+        options = list(graphCreator.graph_options)
+        options[options.index("--width")+1] = str(width)
+        options[options.index("--height")+1] = str(height)
+        result = rrdtool.graphv('-', "--start", start, "--end", end, *(options + defs))
+        image = result['image']
+
+        with self._lock:
+            self._cache[key] = image
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return etag, image
+
+
+class AlertRule(object):
+    #Thresholds of one rule, None disables a check. rate is in degrees per minute
+    #and stale in seconds without a reading
+    __slots__ = ('minimum', 'maximum', 'rate', 'stale', 'hysteresis')
+
+    def __init__(self, minimum=None, maximum=None, rate=None, stale=None, hysteresis=1.0):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.rate = rate
+        self.stale = stale
+        self.hysteresis = hysteresis
+
+class AlertState(object):
+    #Per sensor alert state. An alert is raised once when a threshold is crossed and
+    #re-armed only after the reading is back by more than the rule's hysteresis
+    __slots__ = ('rule', 'name', 'below', 'above', 'fast', 'last_reading', 'last_time')
+
+    def __init__(self, rule, name):
+        self.rule = rule
+        self.name = name
+        self.below = False
+        self.above = False
+        self.fast = False
+        self.last_reading = None
+        self.last_time = None
+
+class AlertEngine(object):
+    #Evaluates readings against per sensor and per host rules. Rules are looked up
+    #once per sensor, most specific first: host and sensor id, host and sensor name,
+    #host, sensor id, sensor name and finally the default rule (None, None). After
+    #that a reading is a dict lookup and a few comparisons, without any I/O.
+    #Alerts are returned as (topic suffix, message) tuples for the caller to publish.
+    #Stale rules are enforced by StalenessWatchdog
+
+    def __init__(self, rules=None, resolve_name=None):
+        self.rules = rules if rules is not None else {}
+        self.resolve_name = resolve_name
+        self.states = {}
+
+    @classmethod
+    def load(cls, filename=None, alertsensor=None, alertmin=None, alertmax=None, resolve_name=None):
+        #filename is a JSON file {"rules": [{"host": ..., "sensor": ..., "min": ...,
+        #"max": ..., "rate": ..., "stale": ..., "hysteresis": ...}, ...]}, where a
+        #missing host or sensor matches any. The legacy --alertsensor, --alertmin and
+        #--alertmax flags become a rule per sensor name
+        rules = {}
+        if alertsensor is not None and (alertmin is not None or alertmax is not None):
+            for name in alertsensor:
+                rules[(None, name)] = AlertRule(alertmin, alertmax)
+        if filename is not None:
+            with open(filename) as f:
+                config = json.load(f)
+            for r in config.get('rules', []):
+                rules[(r.get('host'), r.get('sensor'))] = AlertRule(r.get('min'), r.get('max'), r.get('rate'), r.get('stale'), r.get('hysteresis', 1.0))
+        logging.info("loaded %d alert rules" % len(rules))
+        return cls(rules, resolve_name)
+
+    def compile(self, host, sensor):
+        name = sensor
+        if self.resolve_name is not None:
+            name = self.resolve_name(host, sensor)
+        rule = None
+        for key in ((host, sensor), (host, name), (host, None), (None, sensor), (None, name), (None, None)):
+            rule = self.rules.get(key)
+            if rule is not None:
+                break
+        state = self.states[(host, sensor)] = AlertState(rule, name)
+        return state
+
+    def forget(self, host, sensor):
+        #Recompiles the sensor on its next reading, e.g. after a name change
+        self.states.pop((host, sensor), None)
+
+    def evaluate(self, host, sensor, reading, timestamp):
+        state = self.states.get((host, sensor))
+        if state is None:
+            state = self.compile(host, sensor)
+        rule = state.rule
+        last_reading = state.last_reading
+        last_time = state.last_time
+        state.last_reading = reading
+        state.last_time = timestamp
+        if rule is None:
+            return ()
+
+        alerts = []
+        if rule.minimum is not None:
+            if reading < rule.minimum:
+                if not state.below:
+                    state.below = True
+                    alerts.append(('minimum', "sensor %s on host %s has reached %02.2fC" % (state.name,host,reading)))
+            elif reading > rule.minimum + rule.hysteresis:
+                state.below = False
+        if rule.maximum is not None:
+            if reading > rule.maximum:
+                if not state.above:
+                    state.above = True
+                    alerts.append(('maximum', "sensor %s on host %s has reached %02.2fC" % (state.name,host,reading)))
+            elif reading < rule.maximum - rule.hysteresis:
+                state.above = False
+        if rule.rate is not None and last_time is not None and timestamp > last_time:
+            rate = (reading - last_reading) * 60.0 / (timestamp - last_time)
+            if abs(rate) > rule.rate:
+                if not state.fast:
+                    state.fast = True
+                    alerts.append(('rate', "sensor %s on host %s changes %02.2fC per minute" % (state.name,host,rate)))
+            else:
+                state.fast = False
+        return alerts
+
+    def stale_timeout(self, host, sensor):
+        state = self.states.get((host, sensor))
+        if state is None:
+            state = self.compile(host, sensor)
+        return state.rule.stale if state.rule is not None else None
+
+
+class StalenessWatchdog(Thread):
+    #Raises an alert when a sensor has not sent a reading within its timeout. Every
+    #sensor has one deadline in a min-heap; a reading only moves the deadline in
+    #self.deadlines, and a heap entry that turns out to be outdated when it expires
+    #is pushed again with the current deadline. So a reading is O(1), the thread
+    #sleeps until the earliest deadline, and an outage is reported once, followed
+    #by a recovery notification when the sensor is back
+
+    def __init__(self, mqttClient, timeout=600, get_timeout=None, get_name=None):
+        super(StalenessWatchdog, self).__init__()
+        self.daemon = True
+        self.mqttClient = mqttClient
+        self.timeout = timeout
+        self.get_timeout = get_timeout
+        self.get_name = get_name
+        self.protocol = ThermometerProtocol()
+        self.heap = []
+        self.deadlines = {}
+        self.timeouts = {}
+        self.last_seen = {}
+        self.stale = set()
+        self.alerts = 0
+        self.condition = threading.Condition()
+
+    def sensor_timeout(self, key):
+        timeout = self.timeouts.get(key)
+        if timeout is None:
+            if self.get_timeout is not None:
+                timeout = self.get_timeout(*key)
+            timeout = self.timeouts[key] = timeout if timeout is not None else self.timeout
+        return timeout
+
+    def forget(self, host, sensor):
+        #Looks the timeout up again, e.g. after a name change
+        self.timeouts.pop((host, sensor), None)
+
+    def refresh(self, host, sensor, last_seen=None):
+        key = (host, sensor)
+        now = time.time()
+        if last_seen is None:
+            last_seen = now
+        deadline = time.monotonic() + last_seen + self.sensor_timeout(key) - now
+        with self.condition:
+            self.last_seen[key] = last_seen
+            if key not in self.deadlines:
+                heapq.heappush(self.heap, (deadline, key))
+                self.condition.notify()
+            self.deadlines[key] = deadline
+            recovered = key in self.stale
+            if recovered:
+                self.stale.discard(key)
+        if recovered:
+            self.notify(host, sensor, 'recovered', "Sensor %s on host %s is sending readings again" % (self.sensor_name(host,sensor),host))
+
+    def sensor_name(self, host, sensor):
+        return self.get_name(host, sensor) if self.get_name is not None else sensor
+
+    def notify(self, host, sensor, suffix, message):
+        logging.info(message)
+        self.mqttClient.publish('/surveillance/notification/%s/temperature/%s' % (host,suffix),self.protocol.new_notification(message),2)
+
+    def get_stats(self):
+        with self.condition:
+            return {'sensors':len(self.deadlines) + len(self.stale), 'stale':len(self.stale), 'alerts':self.alerts}
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.heap:
+                    self.condition.wait()
+                deadline, key = self.heap[0]
+                wait = deadline - time.monotonic()
+                if wait > 0:
+                    self.condition.wait(wait)
+                    continue
+                heapq.heappop(self.heap)
+                current = self.deadlines[key]
+                if current > deadline:
+                    heapq.heappush(self.heap, (current, key))
+                    continue
+                del self.deadlines[key]
+                self.stale.add(key)
+                self.alerts += 1
+                last_seen = self.last_seen[key]
+            host, sensor = key
+            try:
+                self.notify(host, sensor, 'stale', "Sensor %s on host %s, last update %s" % (self.sensor_name(host,sensor),host,datetime.datetime.fromtimestamp(last_seen)))
+            except Exception as e:
+                logging.exception(e)
+
+
+class IngestLane(object):
+    #A group of worker threads, each with its own bounded queue. Messages with the
+    #same key always go to the same worker, which keeps them in order
+
+    def __init__(self, name, handler, workers=1, maxsize=1000, stats_interval=300):
+        self.name = name
+        self.handler = handler
+        self.queues = [queue.Queue(maxsize) for i in range(workers)]
+        self.threads = []
+        self.stats_interval = stats_interval
+        self._lock = threading.Lock()
+        self._last_stats = time.time()
+        self.processed = 0
+        self.errors = 0
+        self.blocked = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+
+    def start(self):
+        for q in self.queues:
+            t = Thread(target=self._run, args=(q,), name="ingest-%s" % self.name)
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+
+    def stop(self):
+        for q in self.queues:
+            q.put(None)
+        for t in self.threads:
+            t.join()
+
+    def put(self, key, *args):
+        q = self.queues[hash(key) % len(self.queues)]
+        item = (time.time(), args)
+        try:
+            q.put_nowait(item)
+        except queue.Full:
+            #Blocking here stalls the network loop, which pushes back on the broker
+            self.blocked += 1
+            logging.warning("%s ingest queue is full, waiting" % self.name)
+            q.put(item)
+
+    def get_stats(self):
+        with self._lock:
+            processed = self.processed
+            return {'queue_depth':sum(q.qsize() for q in self.queues),
+                    'processed':processed,
+                    'errors':self.errors,
+                    'blocked':self.blocked,
+                    'avg_latency_ms':self.latency_total * 1000.0 / processed if processed else 0.0,
+                    'max_latency_ms':self.latency_max * 1000.0}
+
+    def _run(self, q):
+        while True:
+            item = q.get()
+            if item is None:
+                break
+            queued, args = item
+            try:
+                self.handler(*args)
+            except Exception as e:
+                with self._lock:
+                    self.errors += 1
+                logging.exception(e)
+            #Latency from the message being received to it being processed
+            latency = time.time() - queued
+            with self._lock:
+                self.processed += 1
+                self.latency_total += latency
+                self.latency_max = max(self.latency_max, latency)
+                log_stats = time.time() - self._last_stats >= self.stats_interval
+                if log_stats:
+                    self._last_stats = time.time()
+            if log_stats:
+                logging.info("%s ingest lane: %s" % (self.name,self.get_stats()))
+
+
+class IngestPipeline(object):
+    #Moves message processing out of the paho network thread. With workers=0
+    #messages are processed inline, in the network thread
+
+    def __init__(self, handlers, workers=2, maxsize=1000):
+        self.handlers = handlers
+        self.lanes = {}
+        if workers > 0:
+            for name in handlers:
+                #Readings are spread over several workers, images are rare enough
+                #for one
+                n = workers if name == 'readings' else 1
+                self.lanes[name] = IngestLane(name, handlers[name], n, maxsize)
+
+    def start(self):
+        for name in self.lanes:
+            self.lanes[name].start()
+
+    def stop(self):
+        for name in self.lanes:
+            self.lanes[name].stop()
+
+    def put(self, lane, key, *args):
+        if lane in self.lanes:
+            self.lanes[lane].put(key, *args)
+        else:
+            self.handlers[lane](*args)
+
+    def get_stats(self):
+        return dict((name, self.lanes[name].get_stats()) for name in self.lanes)
+
+
+def host_shard(host, shards):
+    #crc32 and not hash(), which is salted differently in every process
+    return zlib.crc32(ImageStore.safe_host(host).encode('utf-8')) % shards
+
+def run_ingest_shard(args, index, shards, control, replies):
+    #Entry point of an ingest process. Ctrl-C reaches the whole process group, the
+    #coordinator turns it into a stop command so the shard can flush first
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    server = ThermometerServer()
+    server.shard = (index, shards)
+    server.run_shard(args, control, replies)
+
+class IngestShards(object):
+    #Runs the ingest side of the server in several processes. Every host hashes to
+    #one of them, which owns its RRD files, images, incremental timelapse, alert
+    #and staleness state, so the processes share nothing but the SQLite database.
+    #Each process has a control queue, replies come back on a shared queue. The
+    #coordinator hands this to the graph creator in place of the RRDUpdater and to
+    #the timelapse creator in place of the IncrementalTimelapse, so graphs see the
+    #updates the shards buffer and finished days are joined by their owner
+
+    def __init__(self, args, processes, timeout=60):
+        self.args = args
+        self.processes = processes
+        self.timeout = timeout
+        self.context = multiprocessing.get_context('spawn')
+        self.replies = self.context.Queue()
+        self.controls = [None] * processes
+        self.workers = [None] * processes
+        self.sequence = 0
+        self.restarts = 0
+        self.stopping = False
+        self._lock = threading.Lock()
+
+    def start_shard(self, index):
+        self.controls[index] = self.context.Queue()
+        p = self.context.Process(target=run_ingest_shard, args=(self.args, index, self.processes, self.controls[index], self.replies), name="ingest-%d" % index)
+        p.daemon = True
+        p.start()
+        self.workers[index] = p
+
+    def start(self):
+        #Returns once every shard is connected and consuming
+        for index in range(self.processes):
+            self.start_shard(index)
+        missing = self.wait('ready', set(range(self.processes)), self.timeout)
+        if missing:
+            raise RuntimeError("ingest processes %s did not start" % sorted(missing))
+        logging.info("started %d ingest processes" % self.processes)
+        return self
+
+    def wait(self, key, pending, timeout):
+        #Collects the replies to key from the shards in pending, returns the missing ones
+        deadline = time.monotonic() + timeout
+        while pending:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                reply, index = self.replies.get(timeout=min(remaining, 1.0))
+            except queue.Empty:
+                #A shard that died will not answer
+                if not any(self.workers[i].is_alive() for i in pending):
+                    break
+                continue
+            if reply == key:
+                pending.discard(index)
+        return pending
+
+    def call(self, command, arg=None):
+        #Sends command to every running shard and waits until they have all done it
+        with self._lock:
+            self.sequence += 1
+            pending = set()
+            for index, control in enumerate(self.controls):
+                if self.workers[index].is_alive():
+                    control.put((command, arg, self.sequence))
+                    pending.add(index)
+            missing = self.wait(self.sequence, pending, self.timeout)
+        if missing:
+            logging.warning("ingest processes %s did not answer %s" % (sorted(missing),command))
+
+    def flush(self):
+        #RRDUpdater.flush
+        self.call('flush')
+
+    def finalize_before(self, date):
+        #IncrementalTimelapse.finalize_before
+        self.call('finalize', date)
+
+    def check(self):
+        #Restarts shards that died, their hosts' messages are lost until they are back
+        for index, p in enumerate(self.workers):
+            if not self.stopping and not p.is_alive():
+                logging.error("ingest process %d exited with %s, restarting" % (index,p.exitcode))
+                self.restarts += 1
+                self.start_shard(index)
+
+    def stop(self):
+        self.stopping = True
+        for index, control in enumerate(self.controls):
+            if self.workers[index].is_alive():
+                control.put(('stop', None, 0))
+        for p in self.workers:
+            p.join(self.timeout)
+            if p.is_alive():
+                logging.warning("ingest process %s did not stop, terminating" % p.name)
+                p.terminate()
+
+    def get_stats(self):
+        return {'processes':self.processes,
+                'alive':sum(1 for p in self.workers if p is not None and p.is_alive()),
+                'restarts':self.restarts}
 
 
 class ThermometerServer(object):
     protocol = None
-    lastmin = 99999
-    lastmax = -99999
+    incrementalTimelapse = None
+    imageRetention = 'keep'
+    timelapseRendition = 'full'
+    #(index, count) in an ingest process, which only handles the hosts hashing to index
+    shard = None
 
     def __init__(self):
         self.protocol = ThermometerProtocol()
+        #Subscription, topic prefix and handler per message type. The server only
+        #subscribes to these, so its own notifications and stats never come back to it
+        self.routes = [(TEMPERATURE_TOPIC + '#', TEMPERATURE_TOPIC, self.timed(self.on_temperature_message)),
+                       (BINARY_READING_TOPIC + '+', BINARY_READING_TOPIC, self.timed(self.on_binary_reading_message)),
+                       (BINARY_IMAGE_TOPIC + '#', BINARY_IMAGE_TOPIC, self.timed(self.on_image_message)),
+                       (IMAGE_TOPIC + '#', IMAGE_TOPIC, self.timed(self.on_image_message))]
+
+    def add_routes(self, client):
+        for subscription, prefix, callback in self.routes:
+            client.message_callback_add(subscription, callback)
 
     def on_connect(self, client, userdata, flags, rc):
-        client.subscribe("/surveillance/#",2)
+        client.subscribe([(subscription, 2) for subscription, prefix, callback in self.routes])
+
+    def owns_host(self, host):
+        return self.shard is None or host_shard(host, self.shard[1]) == self.shard[0]
+
+    @staticmethod
+    def topic_host(topic):
+        #The client identifier, which is the host of the messages. It is the last level
+        #of /surveillance/temperature/<postfix>/<host>, and the level after the prefix
+        #of /surveillance/readingbin/<host>, /surveillance/imagebin/<host>[/preview]
+        #and /surveillance/image/<host>
+        if topic.startswith(TEMPERATURE_TOPIC):
+            return topic.rstrip('/').rsplit('/', 1)[-1]
+        for prefix in (BINARY_READING_TOPIC, BINARY_IMAGE_TOPIC, IMAGE_TOPIC):
+            if topic.startswith(prefix):
+                return topic[len(prefix):].split('/', 1)[0]
+        return topic
+
+    def timed(self, handler):
+        def callback(client, userdata, msg):
+            #Every ingest process gets every message, the host is taken from the
+            #topic, so messages of other processes' hosts are dropped unparsed
+            if self.shard is not None and not self.owns_host(self.topic_host(msg.topic)):
+                SHARD_MESSAGES_SKIPPED.inc()
+                return
+            MESSAGES_RECEIVED.inc()
+            with RECEIVE_SECONDS.time():
+                try:
+                    handler(client, userdata, msg)
+                except Exception as e:
+                    MESSAGE_ERRORS.inc()
+                    logging.exception(e)
+        return callback
 
     def on_message(self, client, userdata, msg):
-        logging.info("received message with topic"+msg.topic)
-        try:
-            msgData = msg.payload.decode('utf-8')
-            dataDict = self.protocol.parse_message(msgData)
-            database = self.database
-
-            if('register_sensor' in dataDict):
-                logging.debug('received request to register new sensor')
-                sens = dataDict['register_sensor']
-                if(database.get_sensor(sens['host'],sens['sensor']) is None):
-                    logging.info("registering new sensor with host %s, sensor %s" % (sens['host'],sens['sensor']))
-                    database.register_sensor(sens['host'],sens['sensor'])
-                    self.setup_rrd(sens['host'],sens['sensor'])
-
-            elif('reading' in dataDict):
-                reading = dataDict['reading']
-                host = reading['host']
-                sensor = reading['sensor']
-                logging.debug(reading)
-
-                #database.insert_reading(reading['host'],reading['sensor'],reading['timestamp'],reading['reading'])
-                database.update_last_update(int(time.time()),reading['host'],reading['sensor'])
-                self.update_rrd(host,sensor,reading['reading'],reading['timestamp'])
-                self.check_notification(host,sensor,reading['reading'],userdata,client)
-
-            elif('surveillance' in dataDict):
-                surv = dataDict['surveillance']
-                img = b64decode(surv['image'].encode('ascii'))
-                fname = 'surveillance_%s_%s.jpeg' % (surv['host'],surv['timestamp'])
-                with open(os.path.join(self.surveillanceImagePath,fname),'wb') as f:
-                    f.write(img)
-                database.insert_surveillance(surv['host'],fname,surv['timestamp'])
-        except Exception as e:
-            logging.exception(e)
+        #Messages no specific callback matched, routed by topic prefix
+        for subscription, prefix, callback in self.routes:
+            if msg.topic.startswith(prefix):
+                callback(client, userdata, msg)
+                return
+        logging.debug("ignoring message with topic %s", msg.topic)
+
+    #The handlers run in the paho network thread, so they only parse what is
+    #needed to pick a lane and queue the message
+
+    def on_temperature_message(self, client, userdata, msg):
+        with PARSE_SECONDS.time():
+            kind, body = self.protocol.parse_typed_message(msg.payload)
+        if kind == 'reading':
+            self.pipeline.put('readings',(body['host'],body['sensor']),client,userdata,body)
+        elif kind == 'readings':
+            for reading in self.protocol.parse_reading_batch(body):
+                self.pipeline.put('readings',(reading['host'],reading['sensor']),client,userdata,reading)
+        else:
+            #register_sensor and sensor_alias, in the same lane and worker as the
+            #sensor's readings, so a new sensor is registered before its first reading
+            self.pipeline.put('readings',(body['host'],body['sensor']),client,userdata,body)
+
+    def on_binary_reading_message(self, client, userdata, msg):
+        with PARSE_SECONDS.time():
+            readings = self.protocol.parse_binary_reading_batch(msg.payload)
+        for reading in readings:
+            self.pipeline.put('readings',(reading['host'],reading['sensor']),client,userdata,reading)
+
+    def on_image_message(self, client, userdata, msg):
+        #The payload is only looked at by the image worker
+        self.pipeline.put('images',msg.topic,client,userdata,msg)
+
+    def handle_sensor_message(self, client, userdata, body):
+        if 'reading' in body:
+            self.handle_reading(client, userdata, body)
+        else:
+            self.handle_registration(client, userdata, body)
+
+    def handle_registration(self, client, userdata, sens):
+        if 'alias' in sens:
+            logging.info("setting alias of sensor %s on host %s to %s" % (sens['sensor'],sens['host'],sens['alias']))
+            self.registry.set_alias(sens['host'],sens['sensor'],sens['alias'])
+            return
+        logging.debug('received request to register new sensor')
+        if self.registry.register(sens['host'],sens['sensor']):
+            logging.info("registering new sensor with host %s, sensor %s" % (sens['host'],sens['sensor']))
+            self.setup_rrd(sens['host'],sens['sensor'])
+
+    def handle_reading(self, client, userdata, reading):
+        host = reading['host']
+        sensor = reading['sensor']
+        logging.debug(reading)
+        #Older clients send the reading as a string
+        value = float(reading['reading'])
+        if not math.isfinite(value):
+            raise ValueError("reading %s of sensor %s on host %s is not a number" % (reading['reading'],sensor,host))
+        READINGS_PROCESSED.inc()
+
+        epoch = to_epoch(reading['timestamp'])
+        info = self.registry.get(host,sensor)
+        if info is not None:
+            self.readingStore.append(info.id,epoch,value)
+        self.registry.touch(host,sensor,int(time.time()))
+        self.watchdog.refresh(host,sensor)
+        self.update_rrd(host,sensor,value,epoch)
+        self.check_notification(host,sensor,value,epoch,client)
+
+    def handle_image(self, client, userdata, msg):
+        if msg.topic.startswith(BINARY_IMAGE_TOPIC):
+            header, image = self.protocol.parse_binary_image(msg.payload)
+            self.store_image(header['host'],header['timestamp'],image,header.get('rendition','full'))
+        else:
+            #Legacy base64 in JSON image message
+            dataDict = self.protocol.parse_message(msg.payload)
+            surv = dataDict['surveillance']
+            img = b64decode(surv['image'].encode('ascii'))
+            self.store_image(surv['host'],surv['timestamp'],img)
+
+    def store_image(self, host, timestamp, image, rendition='full'):
+        with IMAGE_WRITE_SECONDS.time():
+            self._store_image(host, timestamp, image, rendition)
+
+    def _store_image(self, host, timestamp, image, rendition):
+        if self.incrementalTimelapse is not None:
+            if rendition == self.timelapseRendition:
+                date = datetime.datetime.fromtimestamp(to_epoch(timestamp)).date().isoformat()
+                self.incrementalTimelapse.add_frame(ImageStore.safe_host(host),date,image)
+            #Nothing cleans up stored days in incremental mode, so the retention
+            #applies to the other rendition too
+            if self.imageRetention == 'drop':
+                return
+            if self.imageRetention == 'thumbnail':
+                self.imageStore.store(host,timestamp,image,rendition,self.incrementalTimelapse.write_thumbnail)
+                return
+        self.imageStore.store(host,timestamp,image,rendition)
 
 
     def on_discconect(self, client, userdata, rc):
         client.reconnect()
 
 
-    def check_notification(self, host, sensor, reading, userdata, client):
-        threshold_temp = None
-        last_alert = None
-        if userdata.alertsensor is None:
-            return
-        sname = SurveillanceDatabase.get_instance().get_sensor_name(host,sensor)
-        topic_suffix = None
-        if sname not in userdata.alertsensor:
-            return
-        if userdata.alertmin is not None:
-            #pdb.set_trace()
-            if (reading < userdata.alertmin) and (reading < (self.lastmin-1.0)):
-                threshold_temp = userdata.alertmin
-                last_alert = self.lastmin
-                self.lastmin = float(reading)
-                topic_suffix = 'minimum'
-            elif reading > userdata.alertmin:
-                self.lastmin = 99999
-
-        if userdata.alertmax is not None:
-            if (reading > userdata.alertmax) and (reading > (self.lastmax+1.0)):
-                threshold_temp = userdata.alertmax
-                last_alert = self.lastmax
-                self.lastmax = float(reading)
-                topic_suffix = 'maximum'
-            elif reading < userdata.alertmax:
-                self.lastmax = -99999
-
-        if threshold_temp is not None:
-            #pdb.set_trace()
-            logging.info("threshold reached, %f < %f (last %f)" % (reading, threshold_temp, last_alert))
-            d = self.protocol.new_notification("sensor %s on host %s has reached %02.2fC" % (sname,host,reading))
-            client.publish('/surveillance/notification/%s/temperature/%s' % (host,topic_suffix),d,2)
-
+    def check_notification(self, host, sensor, reading, timestamp, client):
+        for suffix, message in self.alertEngine.evaluate(host,sensor,float(reading),timestamp):
+            logging.info(message)
+            d = self.protocol.new_notification(message)
+            client.publish('/surveillance/notification/%s/temperature/%s' % (host,suffix),d,2)
 
     def setup_rrd(self, host, sensor):
         try:
@@ -498,36 +2262,34 @@ class ThermometerServer(object):
             logging.exception(e)
 
     def update_rrd(self, host, sensor, reading, timestamp=None):
-        template = "%s" % "a"
-        update = "N:%f" % reading
+        epoch = int(time.time())
         if timestamp is not None:
             try:
-                update = "%s:%f" % (datetime.datetime.strptime(timestamp,"%Y-%m-%d %H:%M:%S.%f").strftime("%s"),reading)
+                epoch = to_epoch(timestamp)
             except Exception as e:
                 logging.exception(e)
 
-        rrdfile = os.path.join(self.rrdPath,"%s_%s_temperature.rrd" % (host,sensor))
-        logging.debug("RRD update : %s, %s" % (template,update))
-        rrdtool.update(rrdfile ,"--template",template, update)
+        self.rrdUpdater.update(self.registry.rrdfile(host,sensor),epoch,float(reading))
 
 
-    def setup(self, prefix):
+    def setup(self, prefix, batch_size=0, batch_interval=1000, synchronous='NORMAL', chunk_size=10000):
         self.databasePath = os.path.join(prefix,"database")
         self.databaseFile = os.path.join(self.databasePath,"surveillance.sqlite3")
         self.rrdPath = os.path.join(prefix,"rrd")
+        self.readingPath = os.path.join(prefix,"readings")
         self.imagePath = os.path.join(prefix,"images")
         self.surveillanceImagePath = os.path.join(self.imagePath,"surveillance")
         self.rrdImagePath = os.path.join(self.imagePath,"rrd")
         self.timelapsePath = os.path.join(self.imagePath,"timelapse")
 
-        for p in (self.databasePath, self.rrdPath, self.imagePath, self.surveillanceImagePath, self.rrdImagePath, self.timelapsePath):
+        for p in (self.databasePath, self.rrdPath, self.readingPath, self.imagePath, self.surveillanceImagePath, self.rrdImagePath, self.timelapsePath):
             logging.info("PATH:"+p)
             if not os.path.exists(p):
                 os.makedirs(p)
 
-        self.database.open(self.databaseFile)
+        self.database.open(self.databaseFile, batch_size, batch_interval, synchronous, chunk_size)
 
-    def get_args(self):
+    def get_args(self, argv=None):
         ap = argparse.ArgumentParser()
         ap.add_argument('-H','--host',help="MQTT Host to connect to", default='localhost')
         ap.add_argument('-p','--port',help="MQTT port to connect to", type=int, default='1883')
@@ -535,8 +2297,49 @@ class ThermometerServer(object):
         ap.add_argument('-m','--alertmin',help="Send notification when temperature goes below this value", type=int)
         ap.add_argument('-M','--alertmax',help="Send notification when temperature goes above this value", type=int)
         ap.add_argument('-s','--alertsensor',help="Sensor to monitor for alerts",nargs='+')
+        ap.add_argument('--stale-timeout',help="Send a notification when a sensor has not sent a reading for this many seconds, unless an alert rule sets its own stale limit", type=int, default=600)
+        ap.add_argument('--alert-rules',help="JSON file with per host and per sensor alert rules (min, max, rate, stale)")
         ap.add_argument('-v', help="Increase log level, can be specified multiple times", action='count', default=1)
-        args = ap.parse_args()
+        ap.add_argument('--db-batch-size',help="Commit database writes in batches of this many rows, 0 commits every write", type=int, default=100)
+        ap.add_argument('--db-batch-interval',help="Maximum time in milliseconds a database write is kept in the batch", type=int, default=1000)
+        ap.add_argument('--db-synchronous',help="SQLite synchronous setting, trading durability for write speed", choices=['OFF','NORMAL','FULL'], default='NORMAL')
+        ap.add_argument('--reading-retention',help="Number of days of raw readings to keep, default is to keep everything", type=int)
+        ap.add_argument('--reading-block-rows',help="Number of readings buffered before they are appended to the reading store", type=int, default=64)
+        ap.add_argument('--ingest-workers',help="Number of threads processing readings, 0 processes messages in the MQTT network thread", type=int, default=2)
+        ap.add_argument('--ingest-processes',help="Number of processes handling messages, every host is handled by one of them. 0 handles them in the server process", type=int, default=0)
+        ap.add_argument('--ingest-queue-size',help="Maximum number of queued messages per ingest worker", type=int, default=1000)
+        ap.add_argument('--last-update-interval',help="Seconds between writes of the sensors' last update times to the database", type=int, default=60)
+        ap.add_argument('--rrd-batch-size',help="Number of updates buffered per RRD file before they are written", type=int, default=5)
+        ap.add_argument('--rrd-flush-interval',help="Maximum time in seconds an RRD update is buffered", type=int, default=300)
+        ap.add_argument('--rrdcached',help="Address of an rrdcached daemon to send RRD updates to, e.g. unix:/var/run/rrdcached.sock")
+        ap.add_argument('--latitude',help="Latitude used for the night shading of the graphs", type=float, default=55.6761)
+        ap.add_argument('--longitude',help="Longitude used for the night shading of the graphs", type=float, default=12.5683)
+        ap.add_argument('--graph-schedule',help="Render interval in seconds per graph, e.g. hour=60 year=21600", nargs='+', default=[])
+        ap.add_argument('--graph-workers',help="Number of processes rendering graphs, 0 renders in the graph thread", type=int)
+        ap.add_argument('--http-port',help="Serve graphs rendered on request on this port", type=int)
+        ap.add_argument('--http-bind',help="Address to bind the graph HTTP server to", default='127.0.0.1')
+        ap.add_argument('--http-cache-size',help="Number of rendered graphs kept by the graph HTTP server", type=int, default=32)
+        ap.add_argument('--http-flush-interval',help="Minimum time in seconds between writes of buffered RRD updates for graph requests", type=int, default=60)
+        ap.add_argument('--image-dedup',help="Store identical frames of a day only once", action='store_true')
+        ap.add_argument('--timelapse-encoder',help="Encoder used for timelapse videos", choices=sorted(TIMELAPSE_ENCODERS), default='mencoder')
+        ap.add_argument('--timelapse-workers',help="Number of timelapse videos encoded in parallel, default is the number of CPU cores", type=int)
+        ap.add_argument('--timelapse-nice',help="Niceness the timelapse encoder runs with, it also runs at idle I/O priority", type=int, default=10)
+        ap.add_argument('--timelapse-scale',help="Size timelapse frames are scaled to, empty keeps the image size. Default is 2592:1944, or the image size with --timelapse-rendition preview")
+        ap.add_argument('--timelapse-bitrate',help="Timelapse video bitrate", type=int, default=8000000)
+        ap.add_argument('--timelapse-segment-frames',help="Number of frames encoded per timelapse segment, an interrupted encode resumes at the last finished segment", type=int, default=500)
+        ap.add_argument('--timelapse-mode',help="Encode timelapses once a day (batch) or append every image to a running segment as it arrives (incremental)", choices=['batch','incremental'], default='batch')
+        ap.add_argument('--timelapse-rendition',help="Which image rendition timelapses are made from, days without previews fall back to full resolution", choices=['full','preview'], default='full')
+        ap.add_argument('--timelapse-retention',help="What incremental mode keeps of a received image, of either rendition", choices=['keep','thumbnail','drop'], default='drop')
+        ap.add_argument('--timelapse-thumbnail-scale',help="Size of the images kept with --timelapse-retention thumbnail", default='640:-1')
+        ap.add_argument('--metrics-port',help="Serve metrics in Prometheus text format on this port, ingest process n serves its own on the port + 1 + n", type=int)
+        ap.add_argument('--metrics-bind',help="Address to bind the metrics HTTP server to", default='127.0.0.1')
+        ap.add_argument('--metrics-interval',help="Publish the metrics to /surveillance/stats/server, /surveillance/stats/server/<n> for ingest process n, every this many seconds, 0 disables", type=int, default=0)
+        ap.add_argument('--migrate',help="Migrate the database to the current schema and exit", action='store_true')
+        ap.add_argument('--migrate-chunk-size',help="Number of rows copied per transaction when migrating the database", type=int, default=10000)
+        args = ap.parse_args(argv)
+        if args.timelapse_scale is None:
+            #Previews are not scaled up to the full frame size
+            args.timelapse_scale = '' if args.timelapse_rendition == 'preview' else '2592:1944'
         return args
 
     def dump_args(self, args):
@@ -546,10 +2349,36 @@ class ThermometerServer(object):
             if ardict[a] is not None:
                 logging.info("--%s = %s" % (a,ardict[a]))
 
-    def main(self):
-        args = self.get_args()
-        self.database = SurveillanceDatabase.get_instance()
-        self.setup(args.prefix)
+    def setup_ingest(self, args, client):
+        #Everything a message passes through from on_message on, after setup
+        self.readingStore = ReadingStore(self.readingPath, args.reading_block_rows, retention_days=args.reading_retention)
+        self.rrdUpdater = RRDUpdater(args.rrd_batch_size, args.rrd_flush_interval, args.rrdcached)
+        self.imageStore = ImageStore(self.surveillanceImagePath, args.image_dedup)
+        self.registry = SensorRegistry(self.database, self.rrdPath, args.last_update_interval).load()
+        self.alertEngine = AlertEngine.load(args.alert_rules, args.alertsensor, args.alertmin, args.alertmax, self.registry.name)
+        self.registry.listeners.append(self.alertEngine.forget)
+        self.pipeline = IngestPipeline({'readings':self.handle_sensor_message,
+                                        'images':self.handle_image},
+                                       args.ingest_workers, args.ingest_queue_size)
+        self.watchdog = StalenessWatchdog(client, args.stale_timeout, self.alertEngine.stale_timeout, self.registry.name)
+        self.registry.listeners.append(self.watchdog.forget)
+        for name, lane in self.pipeline.lanes.items():
+            REGISTRY.gauge('ingest_queue_depth', "Messages waiting in an ingest lane", {'lane':name}, lambda lane=lane: lane.get_stats()['queue_depth'])
+        REGISTRY.gauge('rrd_pending_updates', "Readings buffered for RRD files", function=self.rrdUpdater.pending)
+        REGISTRY.gauge('db_queue_depth', "Writes waiting for the database writer", function=lambda: self.database.get_stats().get('queue_depth', 0))
+        REGISTRY.gauge('stale_sensors', "Sensors without a recent reading", function=lambda: self.watchdog.get_stats()['stale'])
+        self.timelapseRendition = args.timelapse_rendition
+        if args.timelapse_mode == 'incremental':
+            self.imageRetention = args.timelapse_retention
+            self.incrementalTimelapse = IncrementalTimelapse(self.timelapsePath, bitrate=args.timelapse_bitrate, scale=args.timelapse_scale,
+                                                             thumbnail_scale=args.timelapse_thumbnail_scale, priority=low_priority_command(args.timelapse_nice),
+                                                             owns=self.owns_host if self.shard is not None else None)
+        #Sensors that were already silent before a restart are reported too
+        for info in list(self.registry.sensors.values()):
+            if info.last_update is not None and self.owns_host(info.host):
+                self.watchdog.refresh(info.host, info.sensor, info.last_update)
+
+    def setup_logging(self, args, filename='thermometer_server.log'):
         loglevel = logging.INFO
         if args.v == 2:
             loglevel = logging.INFO
@@ -565,22 +2394,147 @@ class ThermometerServer(object):
         ch.setFormatter(formatter)
         root.addHandler(ch)
         #file handler
-        ch = logging.FileHandler(os.path.join(args.prefix,'thermometer_server.log'))
+        ch = logging.FileHandler(os.path.join(args.prefix,filename))
         ch.setLevel(loglevel)
         ch.setFormatter(formatter)
         root.addHandler(ch)
 
-        self.dump_args(args)
-
+    def connect(self, args, subscribe=True):
         client = paho.Client()
         client.user_data_set(args)
-        client.on_connect = self.on_connect
-        client.on_message = self.on_message
+        if subscribe:
+            client.on_connect = self.on_connect
+            client.on_message = self.on_message
+            self.add_routes(client)
         client.on_discconect = self.on_discconect
         client.connect(args.host, args.port, 60)
-        RRDGraphCreator(self.rrdPath, self.rrdImagePath, self.databaseFile, client).start()
-        TimelapseCreator(self.surveillanceImagePath, self.timelapsePath,self.databaseFile).start()
-        client.loop_forever()
+        return client
+
+    def start_metrics(self, args, client, port_offset=0, topic='/surveillance/stats/server'):
+        if args.metrics_port is not None:
+            MetricsServer(args.metrics_bind, args.metrics_port + port_offset).start()
+        if args.metrics_interval > 0:
+            MetricsPublisher(client, topic, args.metrics_interval).start()
+
+    def start_jobs(self, args, client, registry, rrdUpdater, incremental, imageStore):
+        #Graphs and timelapses, in the server process or the coordinator
+        schedule = dict((name, int(interval)) for name, interval in (s.split('=') for s in args.graph_schedule))
+        self.graphCreator = RRDGraphCreator(self.rrdPath, self.rrdImagePath, self.databaseFile, client, rrdUpdater, schedule, args.graph_workers, registry,
+                                            SolarSchedule(args.latitude, args.longitude, self.databasePath))
+        self.graphCreator.start()
+        if args.http_port is not None:
+            GraphServer(self.graphCreator, args.http_bind, args.http_port, args.http_cache_size, args.http_flush_interval).start()
+        encoder = TIMELAPSE_ENCODERS[args.timelapse_encoder](bitrate=args.timelapse_bitrate, scale=args.timelapse_scale, priority=low_priority_command(args.timelapse_nice))
+        TimelapseCreator(self.surveillanceImagePath, self.timelapsePath, self.databaseFile, encoder, args.timelapse_workers, args.timelapse_segment_frames, incremental,
+                         args.timelapse_rendition, imageStore).start()
+
+    def stop_ingest(self):
+        self.pipeline.stop()
+        logging.info("ingest stats %s" % self.pipeline.get_stats())
+        logging.info("watchdog stats %s" % self.watchdog.get_stats())
+        logging.info("image store stats %s" % self.imageStore.get_stats())
+        self.rrdUpdater.flush()
+        self.registry.flush()
+        if self.incrementalTimelapse is not None:
+            self.incrementalTimelapse.close()
+        logging.info("flushing database, %s" % self.database.get_stats())
+        self.readingStore.close()
+        self.database.close()
+
+    def run_shard(self, args, control, replies):
+        #An ingest process. The coordinator has already created the directories and
+        #migrated the database
+        index, shards = self.shard
+        self.setup_logging(args, 'thermometer_server.%d.log' % index)
+        self.database = SurveillanceDatabase.get_instance()
+        self.setup(args.prefix, args.db_batch_size, args.db_batch_interval, args.db_synchronous, args.migrate_chunk_size)
+        client = self.connect(args)
+        self.setup_ingest(args, client)
+        self.pipeline.start()
+        self.watchdog.start()
+        self.start_metrics(args, client, 1 + index, '/surveillance/stats/server/%d' % index)
+        client.loop_start()
+        logging.info("ingest process %d of %d started" % (index,shards))
+        replies.put(('ready', index))
+        last_load = time.monotonic()
+        try:
+            while True:
+                try:
+                    command, arg, sequence = control.get(timeout=60)
+                except queue.Empty:
+                    command = None
+                if command == 'stop':
+                    break
+                elif command == 'flush':
+                    self.rrdUpdater.flush()
+                elif command == 'finalize' and self.incrementalTimelapse is not None:
+                    #Joining a day's segments takes a while, flushes must not wait for it
+                    Thread(target=self.incrementalTimelapse.finalize_before, args=(arg,), daemon=True).start()
+                if command is not None:
+                    replies.put((sequence, index))
+                #Alias and rrdGraph changes, in the server process the graph creator reloads
+                if time.monotonic() - last_load >= 600:
+                    last_load = time.monotonic()
+                    self.registry.load()
+        finally:
+            logging.info("stopping ingest process %d" % index)
+            client.disconnect()
+            client.loop_stop()
+            self.stop_ingest()
+
+    def run_coordinator(self, args):
+        #Starts the ingest processes and runs graphs and timelapses. It does not
+        #subscribe to anything, the client only publishes graph notifications
+        shards = IngestShards(args, args.ingest_processes)
+        #Shut down through the finally below, which stops the shards first
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        client = self.connect(args, subscribe=False)
+        client.loop_start()
+        try:
+            shards.start()
+            REGISTRY.gauge('ingest_processes_alive', "Ingest processes running", function=lambda: shards.get_stats()['alive'])
+            self.start_metrics(args, client)
+            registry = SensorRegistry(self.database, self.rrdPath, args.last_update_interval).load()
+            self.start_jobs(args, client, registry, shards, shards if args.timelapse_mode == 'incremental' else None, ImageStore(self.surveillanceImagePath))
+            while True:
+                time.sleep(5)
+                shards.check()
+        finally:
+            shards.stop()
+            logging.info("ingest processes %s" % shards.get_stats())
+            client.disconnect()
+            client.loop_stop()
+            self.database.close()
+
+    def main(self):
+        args = self.get_args()
+        self.database = SurveillanceDatabase.get_instance()
+        if args.migrate:
+            logging.basicConfig(format='%(asctime)s %(levelname)s: %(message)s', level=logging.INFO)
+            self.setup(args.prefix, 0, chunk_size=args.migrate_chunk_size)
+            self.database.close()
+            return
+        self.setup(args.prefix, args.db_batch_size, args.db_batch_interval, args.db_synchronous, args.migrate_chunk_size)
+        self.setup_logging(args)
+        self.dump_args(args)
+
+        if args.ingest_processes > 0:
+            self.run_coordinator(args)
+            return
+
+        client = self.connect(args)
+        self.setup_ingest(args, client)
+        self.pipeline.start()
+        self.watchdog.start()
+        self.start_metrics(args, client)
+        self.start_jobs(args, client, self.registry, self.rrdUpdater, self.incrementalTimelapse, self.imageStore)
+        #systemctl stop sends SIGTERM, exit through the finally below so queued
+        #database, RRD and reading writes are flushed
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        try:
+            client.loop_forever()
+        finally:
+            self.stop_ingest()
 
 if __name__ == '__main__':
     t = ThermometerServer()